@@ -0,0 +1,151 @@
+"""
+Generate and verify queries for many schemas in one run, e.g. every index in CI. Compared to
+running gen_queries.py once per schema, the interpreter and libraries start once, and every
+schema's queries go through one pooled client, so connections (and TLS handshakes) are reused and
+the in-flight limit applies across schemas.
+
+Schemas are loaded lazily, when their first query is needed. Each schema generates the same
+queries for a seed as `gen_queries.py [schema] --seed` does, so a failure can be reproduced on its
+own. Queries from different schemas can be sent one schema after another, or interleaved a block
+of queries at a time.
+
+Usage: batch.py [schema...] [--all] [--quantity 10] [--quota schema=N ...] [--order interleaved]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+from compile_schema import load_schema, schema_names
+from duplicates import DuplicateFilter
+from gen_queries import add_run_arguments, generate_queries, verify_or_print
+from metrics import GenerationMetrics
+from validate_query import validate_all
+
+ORDERS = ("sequential", "interleaved")
+
+
+def parse_quotas(specs: list[str], names: list[str], default: int) -> dict[str, int]:
+    """
+    Queries to generate per schema: `default`, except where overridden by a `schema=N` spec.
+    """
+    quotas = dict.fromkeys(names, default)
+    for spec in specs:
+        name, sep, quantity = spec.rpartition("=")
+        if not sep or not quantity.isdigit():
+            raise ValueError(f"quota must look like schema=N, got {spec!r}")
+        if name not in quotas:
+            raise ValueError(f"quota for {name!r}, which isn't one of the schemas being run")
+        quotas[name] = int(quantity)
+    return quotas
+
+
+def schema_queries(
+    schema_name: str,
+    quantity: int,
+    seed: int,
+    metrics: GenerationMetrics | None,
+    duplicates: DuplicateFilter | None,
+    prevalidate: bool,
+):
+    """
+    Queries for one schema, only loading the schema once the first query is asked for. Like
+    gen_queries.py, duplicates (tracked across schemas in `duplicates`) are dropped before
+    prevalidation.
+    """
+    schema = load_schema(schema_name)
+    queries = generate_queries(schema_name, schema, quantity, seed, metrics=metrics)
+    if duplicates is not None:
+        queries = duplicates.filter(queries)
+    if prevalidate:
+        queries = validate_all(queries, schema, schema_name)
+    yield from queries
+
+
+def interleave(streams: list, block: int):
+    """
+    Round robin over `streams`, `block` items from each in turn, until all are exhausted.
+    """
+    streams = list(streams)
+    while streams:
+        for stream in list(streams):
+            taken = list(itertools.islice(stream, block))
+            yield from taken
+            if len(taken) < block:
+                streams.remove(stream)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate and verify random PPL queries for many schemas.")
+    parser.add_argument("schemas", nargs="*", help="schema names, read from schemas/[schema].json")
+    parser.add_argument("--all", action="store_true", help="run every schema in schemas/")
+    parser.add_argument("--quantity", type=int, default=10, help="queries per schema (default 10)")
+    parser.add_argument(
+        "--quota",
+        action="append",
+        default=[],
+        help="queries for one schema, as schema=N, overriding --quantity (can be repeated)",
+    )
+    parser.add_argument(
+        "--order",
+        choices=ORDERS,
+        default="sequential",
+        help="sequential: each schema's queries in turn; interleaved: alternate between schemas (default sequential)",
+    )
+    parser.add_argument(
+        "--block",
+        type=int,
+        default=1,
+        help="with --order interleaved, queries taken from each schema in turn (default 1)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="master seed for generation, used for every schema; the same seed always gives the same queries",
+    )
+    add_run_arguments(parser)
+    args = parser.parse_args()
+    if args.max_in_flight < 1:
+        parser.error("--max-in-flight must be at least 1")
+
+    # Paths like schemas/[schema].json are accepted too, so shell globs work
+    names = {os.path.basename(name).removesuffix(".json") for name in args.schemas}
+    names = sorted(names | set(schema_names() if args.all else []))
+    if not names:
+        parser.error("give at least one schema, or --all")
+    try:
+        quotas = parse_quotas(args.quota, names, args.quantity)
+    except ValueError as e:
+        parser.error(str(e))
+    seed = args.seed if args.seed is not None else random.randrange(2**32)
+    print(f"Using seed {seed} for {len(names)} schemas", file=sys.stderr)
+
+    collect_metrics = args.metrics or args.metrics_out
+    metrics = {name: GenerationMetrics(name) for name in names} if collect_metrics else {}
+    duplicates = DuplicateFilter(args.dedup_capacity, args.dedup_error_rate) if args.dedup else None
+    # Generators don't run until first asked for a query, so schemas load lazily
+    streams = [
+        schema_queries(name, quotas[name], seed, metrics.get(name), duplicates, args.prevalidate)
+        for name in names
+        if quotas[name] > 0
+    ]
+    if args.order == "interleaved":
+        queries = interleave(streams, args.block)
+    else:
+        queries = itertools.chain.from_iterable(streams)
+    verify_or_print(queries, args, seed)
+    if duplicates is not None:
+        print(duplicates.summary(), file=sys.stderr)
+    if args.metrics:
+        for name in names:
+            print(metrics[name].summary(), file=sys.stderr)
+    if args.metrics_out is not None:
+        with open(args.metrics_out, "w") as metrics_file:
+            json.dump(
+                {"seed": seed, "schemas": {name: metrics[name].to_dict() for name in names}},
+                metrics_file,
+                indent=2,
+            )
@@ -0,0 +1,249 @@
+"""
+Reproducible benchmarks for the hot paths: query generation, schema building and verification.
+Every benchmark uses fixed seeds and inputs, and results are written as JSON (with the git
+revision they were measured at) so runs can be compared across revisions.
+
+- generate: queries/s and bytes allocated per query for each bundled schema
+- schema: make_schema.py records/s, MB/s and peak RSS on data/nginx_raw.json, repeated to scale
+- verify: per-query latency and concurrent throughput against a local stub PPL server
+
+Usage: bench.py [--only generate,schema,verify] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from compile_schema import load_schema, schema_names
+from gen_queries import chunk_rng, generate_queries, generate_query
+from context import QueryContext
+from literals import LiteralSampler, seeded_generator
+from make_schema import iter_records
+from revision import git_revision
+
+BENCH_SEED = 20240601
+SCHEMA_DATA = "data/nginx_raw.json"
+BENCHMARKS = ("generate", "schema", "verify")
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    """
+    Latency percentiles in milliseconds.
+    """
+    values = sorted(latencies)
+    return {
+        "mean_ms": statistics.fmean(values) * 1000 if values else 0.0,
+        "p50_ms": percentile(values, 0.50) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "max_ms": values[-1] * 1000 if values else 0.0,
+    }
+
+
+def timed_runs(fn, repeat: int) -> list[float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_generate(schema_name: str, count: int, repeat: int) -> dict:
+    # Loaded the way gen_queries.py loads it, from the compiled form when that's up to date
+    schema = load_schema(schema_name)
+    times = timed_runs(lambda: sum(1 for _ in generate_queries(schema_name, schema, count, BENCH_SEED)), repeat)
+
+    # Allocations are traced separately, since tracing slows generation down several times over.
+    # Each query's figure is the peak memory it allocated on top of what was live before it. The
+    # context is built the same way as in `gen_queries.generate_chunk`.
+    rng = chunk_rng(BENCH_SEED, 0)
+    literals = LiteralSampler(seeded_generator(f"{BENCH_SEED}:0"))
+    allocated = []
+    tracemalloc.start()
+    for _ in range(min(count, 1000)):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        generate_query(schema_name, QueryContext(schema, rng, literals))
+        allocated.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    best = min(times)
+    return {
+        "queries": count,
+        "seconds": times,
+        "queries_per_s": count / best,
+        "us_per_query": best / count * 1e6,
+        "alloc_bytes_per_query_mean": statistics.fmean(allocated),
+        "alloc_bytes_per_query_max": max(allocated),
+    }
+
+
+def write_scaled_data(path: str, scale: int, out_path: str) -> tuple[int, int]:
+    """
+    Write the records of `path` `scale` times over as NDJSON. Returns the record count and size.
+    """
+    records = [json.dumps(record) for record in iter_records(path)]
+    with open(out_path, "w") as out_file:
+        for _ in range(scale):
+            for record in records:
+                out_file.write(record)
+                out_file.write("\n")
+    return len(records) * scale, os.path.getsize(out_path)
+
+
+def run_make_schema(inputs: list[str], processes: int) -> tuple[float, int]:
+    """
+    Run make_schema.py in a fresh process, so its peak memory is measured on its own. Returns the
+    wall time and peak RSS in bytes.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        command = [sys.executable, "make_schema.py", *inputs, os.path.join(tmp_dir, "schema.json")]
+        start = time.perf_counter()
+        process = subprocess.Popen([*command, "--processes", str(processes)])
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"make_schema.py exited with status {process.returncode}")
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return elapsed, peak_rss
+
+
+def bench_schema(scale: int, repeat: int, processes: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if scale == 1:
+            inputs = [SCHEMA_DATA]
+            records, size = sum(1 for _ in iter_records(SCHEMA_DATA)), os.path.getsize(SCHEMA_DATA)
+        else:
+            inputs = [os.path.join(tmp_dir, f"scaled_{scale}.json")]
+            records, size = write_scaled_data(SCHEMA_DATA, scale, inputs[0])
+        runs = [run_make_schema(inputs, processes) for _ in range(repeat)]
+    times = [elapsed for elapsed, _ in runs]
+    best = min(times)
+    return {
+        "scale": scale,
+        "records": records,
+        "bytes": size,
+        "processes": processes,
+        "seconds": times,
+        "records_per_s": records / best,
+        "mb_per_s": size / best / 1e6,
+        "peak_rss_mb": max(peak for _, peak in runs) / 1e6,
+    }
+
+
+def bench_verify(count: int, latency: float, concurrency: list[int]) -> dict:
+    # Imported here so the other benchmarks run without the client library installed
+    from opensearchpy import OpenSearch
+    from stub_server import start_stub_server
+    from verify_query import run_ppl_queries, run_ppl_query
+
+    schema_name = schema_names()[0]
+    queries = list(generate_queries(schema_name, load_schema(schema_name), count, BENCH_SEED))
+
+    server = start_stub_server(latency=latency)
+    try:
+        client = OpenSearch(
+            hosts=[{"host": server.host, "port": server.port}],
+            http_compress=True,
+            pool_maxsize=max(concurrency),
+        )
+        latencies = []
+        for ppl_query in queries:
+            start = time.perf_counter()
+            run_ppl_query(client, ppl_query)
+            latencies.append(time.perf_counter() - start)
+
+        throughput = {}
+        for max_in_flight in concurrency:
+            start = time.perf_counter()
+            for _ in run_ppl_queries(client, queries, max_in_flight):
+                pass
+            throughput[str(max_in_flight)] = count / (time.perf_counter() - start)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {
+        "queries": count,
+        "server_latency_ms": latency * 1000,
+        "latency": latency_summary(latencies),
+        "queries_per_s_by_max_in_flight": throughput,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark query generation, schema building and verification.")
+    parser.add_argument(
+        "--only",
+        default=",".join(BENCHMARKS),
+        help=f"comma separated benchmarks to run, of {', '.join(BENCHMARKS)} (default: all)",
+    )
+    parser.add_argument("--output", default=None, help="file to write JSON results to (default: stdout)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark, the best is reported (default 3)")
+    parser.add_argument("--queries", type=int, default=5000, help="queries generated per schema (default 5000)")
+    parser.add_argument(
+        "--scales",
+        default="1,10,50",
+        help=f"comma separated multiples of {SCHEMA_DATA} to build schemas from (default 1,10,50)",
+    )
+    parser.add_argument("--schema-processes", type=int, default=1, help="make_schema.py processes (default 1)")
+    parser.add_argument("--verify-queries", type=int, default=1000, help="queries sent to the stub server (default 1000)")
+    parser.add_argument(
+        "--stub-latency",
+        type=float,
+        default=0.002,
+        help="seconds the stub server waits before answering, standing in for query execution (default 0.002)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        default="1,8,32",
+        help="comma separated --max-in-flight values to measure verification throughput at (default 1,8,32)",
+    )
+    args = parser.parse_args()
+    only = args.only.split(",")
+    for name in only:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": BENCH_SEED,
+        "benchmarks": {},
+    }
+    if "generate" in only:
+        results["benchmarks"]["generate"] = {}
+        for schema_name in schema_names():
+            print(f"generate: {schema_name}", file=sys.stderr)
+            results["benchmarks"]["generate"][schema_name] = bench_generate(schema_name, args.queries, args.repeat)
+    if "schema" in only:
+        results["benchmarks"]["schema"] = []
+        for scale in map(int, args.scales.split(",")):
+            print(f"schema: {SCHEMA_DATA} x{scale}", file=sys.stderr)
+            results["benchmarks"]["schema"].append(bench_schema(scale, args.repeat, args.schema_processes))
+    if "verify" in only:
+        print("verify: stub server", file=sys.stderr)
+        concurrency = [int(n) for n in args.concurrency.split(",")]
+        results["benchmarks"]["verify"] = bench_verify(args.verify_queries, args.stub_latency, concurrency)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as out_file:
+            json.dump(results, out_file, indent=2)
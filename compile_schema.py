@@ -0,0 +1,92 @@
+"""
+Compile schema files into a precompiled form that gen_queries.py loads without parsing JSON or
+preparing fields: `schemas/[schema].json` becomes `schemas/[schema].compiled`, a pickled `Schema`
+with its key indexes, literal `repr`s, epoch time bounds and compiled parser patterns.
+
+A compiled schema records the size and modification time of the JSON it came from, and is
+ignored once the JSON changes. Compiled schemas are pickles, so only load ones you built.
+
+Usage: compile_schema.py [schema...] (default: every schema in schemas/)
+"""
+
+import json
+import os
+import pickle
+import sys
+import tempfile
+from context import Schema
+
+SCHEMA_DIR = "schemas"
+COMPILED_SUFFIX = ".compiled"
+# Bumped whenever `Schema` or `prepare_field` change what's stored
+COMPILED_SCHEMA_VERSION = 1
+
+
+def schema_names() -> list[str]:
+    """
+    Names of every schema in `SCHEMA_DIR`.
+    """
+    return sorted(f.removesuffix(".json") for f in os.listdir(SCHEMA_DIR) if f.endswith(".json"))
+
+
+def schema_path(schema_name: str) -> str:
+    return os.path.join(SCHEMA_DIR, f"{schema_name}.json")
+
+
+def compiled_path(schema_name: str) -> str:
+    return os.path.join(SCHEMA_DIR, f"{schema_name}{COMPILED_SUFFIX}")
+
+
+def source_stamp(path: str) -> tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def compile_schema(schema_name: str) -> str:
+    """
+    Compile `schemas/[schema_name].json`, returning the path of the compiled schema.
+    """
+    source = schema_path(schema_name)
+    with open(source, "r") as schema_file:
+        schema = Schema(json.load(schema_file))
+    out_path = compiled_path(schema_name)
+    # Written to a temporary file and moved into place, so readers never see a partial pickle
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(out_path), prefix=f".{schema_name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out_file:
+            header = {"version": COMPILED_SCHEMA_VERSION, "source": source_stamp(source)}
+            pickle.dump(header, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(schema, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+        # mkstemp files are private; give it the permissions a plain open() would have
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return out_path
+
+
+def load_schema(schema_name: str) -> Schema:
+    """
+    Load a schema by name, from its compiled form if that's up to date with the JSON, or else from
+    the JSON. An unreadable compiled schema (e.g. truncated, or pickled from classes that have since
+    been renamed or moved) is treated like an out of date one.
+    """
+    source = schema_path(schema_name)
+    try:
+        with open(compiled_path(schema_name), "rb") as compiled_file:
+            header = pickle.load(compiled_file)
+            if header["version"] == COMPILED_SCHEMA_VERSION and tuple(header["source"]) == source_stamp(source):
+                return pickle.load(compiled_file)
+    except (FileNotFoundError, pickle.UnpicklingError, EOFError, KeyError, TypeError, AttributeError, ImportError):
+        pass
+    with open(source, "r") as schema_file:
+        return Schema(json.load(schema_file))
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or schema_names()
+    for name in names:
+        print(f"Compiled {compile_schema(name)}", file=sys.stderr)
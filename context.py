@@ -1,85 +1,394 @@
-import copy
 import random
+import re
 import datetime
+import time
+from collections.abc import MutableMapping
 
 
-class QueryContext(dict):
+class KeyIndex:
     """
-    Wrapper around dict that has some helper methods for usage in gen_queries
+    Set of keys that also supports O(1) random choice: keys are kept in a list, with a position
+    map so removal can swap the last key into the hole.
     """
 
-    def __init__(self, context):
-        # Initialize self as dict for all the familiar methods
-        context = copy.deepcopy(context)
+    def __init__(self, keys=()):
+        self._keys = []
+        self._pos = {}
+        for key in keys:
+            self.add(key)
 
-        context = dict((k, v) for k, v in context.items() if v["type"] != "none")
+    def add(self, key):
+        if key not in self._pos:
+            self._pos[key] = len(self._keys)
+            self._keys.append(key)
 
-        super(QueryContext, self).__init__(context)
-        self.__dict__ == self
+    def discard(self, key):
+        idx = self._pos.pop(key, None)
+        if idx is None:
+            return
+        last = self._keys.pop()
+        if idx < len(self._keys):
+            self._keys[idx] = last
+            self._pos[last] = idx
+
+    def choice(self, rng: random.Random):
+        # Raises IndexError when empty, same as `random.choice`
+        return rng.choice(self._keys)
+
+    def sample(self, rng: random.Random, k: int) -> list:
+        return rng.sample(self._keys, k)
+
+    def copy(self):
+        result = KeyIndex()
+        result._keys = self._keys.copy()
+        result._pos = self._pos.copy()
+        return result
+
+    def __contains__(self, key):
+        return key in self._pos
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return f"KeyIndex({self._keys!r})"
+
+
+def rename_target(key: str) -> str | None:
+    """
+    The name `rename` gives a field: the last part of its key after a separator, e.g. `url` for
+    `http.url`. None if the key has no separator, since it's already as short as it gets.
+    """
+    unquoted = key.strip("`")
+    tail = re.split(r"(_|[^\w])", unquoted)[-1]
+    return None if tail == unquoted else tail
+
+
+# Categories of keys that commands select from, keyed by the `random_item` filter they serve, as
+# predicates over a field's key and properties. "forced" isn't derived from the field, so it's
+# maintained separately.
+INDEX_PREDICATES = {
+    "sortable": lambda key, props: props["type"] in ("text", "int", "float", "time"),
+    "numeric": lambda key, props: props["type"] in ("float", "int"),
+    "time": lambda key, props: props["type"] == "time",
+    "parse": lambda key, props: "parser" in props,
+    "renamable": lambda key, props: rename_target(key) is not None,
+}
+
+
+# Time functions usable in `eval`, with the field they're stored in and their range of values
+TIME_PARTS = {
+    "SECOND": ("second", 0, 59),
+    "MINUTE": ("minute", 0, 59),
+    "HOUR": ("hour", 0, 59),
+    "DAY": ("day", 1, 31),
+    "WEEK": ("week", 1, 52),
+    "MONTH": ("month", 1, 12),
+    "YEAR": ("year", 1970, 2024),
+    "DAY_OF_WEEK": ("day", 1, 7),
+    "DAY_OF_YEAR": ("day", 1, 366)
+}
+
+
+# Operators `where` compares each type of field with. Bools are used bare or negated instead.
+OPERATORS = {
+    "keyword": ["=", "!=", "IN"],
+    "text": ["=", ">", ">=", "<", "<=", "LIKE"],
+    "int": ["=", "!=", ">", ">=", "<", "<="],
+    "float": ["=", "!=", ">", ">=", "<", "<="],
+    # It's not entirely clear what list operations are supported, but '=' and '!=' at least cover
+    # CONTAINS/NOT CONTAINS
+    "list": ["=", "!="],
+    "time": ["=", ">", ">=", "<", "<="],
+    "bool": ["", "NOT"],
+}
+
+
+# Names of grammar features for coverage (see grammar_coverage.py)
+def where_feature(field_type: str, op: str) -> str:
+    return f"where {field_type} {op}".rstrip()
+
+
+def field_feature(command: str, field_type: str) -> str:
+    return f"{command} {field_type}"
+
+
+def to_epoch(timestamp: str) -> float:
+    # Schema times without a timezone are UTC, as in make_schema.py
+    parsed = datetime.datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def prepare_field(props: dict) -> dict:
+    """
+    Copy of a field's properties with everything sampling needs worked out ahead of time: `repr`s
+    of its values, epoch bounds for times, and for parsers the compiled pattern and the fields it
+    extracts. Sampling then never parses anything from the schema.
+    """
+    props = dict(props)
+    match props["type"]:
+        case "keyword" | "text":
+            props["value_reprs"] = [repr(v) for v in props["values"]]
+        case "list":
+            props["item_reprs"] = [repr(v) for v in props["items"]]
+        case "time":
+            props.setdefault("min_epoch", to_epoch(props["min"]))
+            props.setdefault("max_epoch", to_epoch(props["max"]))
+    if "parser" in props:
+        parser = dict(props["parser"])
+        regex = re.compile(parser["pattern"])
+        matches = [regex.match(v) for v in props["values"]]
+        parser["field_props"] = {
+            field: prepare_field(
+                {
+                    "type": props["type"],
+                    "values": [m.group(field) for m in matches],
+                    "nullable": False,
+                    "unique": False,
+                }
+            )
+            for field in parser["fields"]
+        }
+        # Convert from python regex dialect for group to PPL dialect
+        parser["ppl_pattern"] = repr(parser["pattern"].replace("?P<", "?<"))
+        props["parser"] = parser
+    return props
+
+
+class Schema:
+    """
+    Read-only view of a schema file, built once and shared by every QueryContext generated from it.
+    Field properties are never modified in place: contexts record their changes as overlays.
+    """
+
+    def __init__(self, schema: dict):
+        self.fields = dict((k, prepare_field(v)) for k, v in schema.items() if v["type"] != "none")
+        self.indexes = {"all": KeyIndex(self.fields)}
+        for name, predicate in INDEX_PREDICATES.items():
+            self.indexes[name] = KeyIndex(k for k, v in self.fields.items() if predicate(k, v))
+
+
+class QueryContext(MutableMapping):
+    """
+    Wrapper around a schema that has some helper methods for usage in gen_queries.
+
+    The context is copy-on-write: fields come from the shared `Schema` until a command adds,
+    replaces or removes one, and only those changes are stored per query. This keeps setting up a
+    context cheap regardless of how wide the schema is.
+
+    Keys are also indexed by category (see `INDEX_PREDICATES`), and the indexes are kept up to
+    date as fields come and go, so `random_item` doesn't need to scan the context. The indexes are
+    shared with the schema too, and only copied the first time this query changes one.
+    """
+
+    def __init__(self, context: Schema | dict, rng: random.Random | None = None, literals=None, coverage=None):
+        if not isinstance(context, Schema):
+            context = Schema(context)
+        self._base = context.fields
+        # Fields added or replaced by this query, and base fields this query has removed
+        self._overlay = {}
+        self._removed = set()
+        self._len = len(self._base)
+        self._indexes = dict(context.indexes)
+        self._owned_indexes = set()
 
         # Guards are conditions that block values from being generated
         self.seen_segments = []
         # When introducing new fields (e.g. rename, eval), we always want to use those fields later
         # in the query. Otherwise we get queries like `source=example | rename a as b | fields c`.
-        # Force fields tracks fields that should always be in the final context.
-        self.forced_fields = set()
+        # Force fields tracks fields that should always be in the final context. Only fields
+        # currently in the context are tracked, so a field must be added before it's forced.
+        self.forced_fields = KeyIndex()
+        # All randomness for the query goes through this RNG, so a seeded RNG gives reproducible
+        # queries. Code building queries should use `context.rng`, not the global `random` module.
+        self.rng = rng if rng is not None else random.Random()
+        # Optional `literals.LiteralSampler` to take literals from in batches, instead of drawing
+        # each one from `rng`
+        self.literals = literals
+        # Optional `grammar_coverage.CoverageTracker` to record grammar features in, and with an
+        # adaptive tracker, to steer choices toward features it hasn't seen
+        self.coverage = coverage
+
+    def _own_index(self, name: str) -> KeyIndex:
+        if name not in self._owned_indexes:
+            self._indexes[name] = self._indexes[name].copy()
+            self._owned_indexes.add(name)
+        return self._indexes[name]
+
+    def _unindex(self, key):
+        for name, index in self._indexes.items():
+            if key in index:
+                self._own_index(name).discard(key)
+        self.forced_fields.discard(key)
+
+    def __getitem__(self, key):
+        if key in self._overlay:
+            return self._overlay[key]
+        if key in self._removed:
+            raise KeyError(key)
+        return self._base[key]
+
+    def __contains__(self, key):
+        return key in self._overlay or (key in self._base and key not in self._removed)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._len += 1
+            self._own_index("all").add(key)
+        else:
+            for name, predicate in INDEX_PREDICATES.items():
+                if key in self._indexes[name] and not predicate(key, value):
+                    self._own_index(name).discard(key)
+        for name, predicate in INDEX_PREDICATES.items():
+            if predicate(key, value) and key not in self._indexes[name]:
+                self._own_index(name).add(key)
+        self._overlay[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._overlay.pop(key, None)
+        if key in self._base:
+            self._removed.add(key)
+        self._len -= 1
+        self._unindex(key)
+        if len(self._removed) > len(self._base) // 2:
+            # Most of the schema is gone (e.g. after `fields`), so stop paying to skip over it
+            self._overlay = dict(self.items())
+            self._base, self._removed = {}, set()
+
+    def __iter__(self):
+        for key in self._base:
+            if key not in self._removed and key not in self._overlay:
+                yield key
+        yield from self._overlay
+
+    def __len__(self):
+        return self._len
+
+    def rename(self, key, new_key):
+        """
+        Move a field to a new key. Like any new field, the renamed field is forced.
+        """
+        value = self[key]
+        del self[key]
+        self[new_key] = value
+        self.forced_fields.add(new_key)
+
+    def cover(self, feature: str):
+        if self.coverage is not None:
+            self.coverage.cover(feature)
+
+    def _guided(self, features) -> bool:
+        return features is not None and self.coverage is not None and self.coverage.adaptive
+
+    def choose(self, options: list, features=None):
+        """
+        `rng.choice(options)`, unless there's an adaptive coverage tracker and `features` gives the
+        tuple of features each option can lead to, in which case options are weighted by coverage.
+        """
+        if self._guided(features):
+            return self.coverage.choose(self.rng, options, features)
+        return self.rng.choice(options)
 
     # Helper for `Context.random_item` that only returns the key.
     def random_key(self, **kwargs):
         return self.random_item(**kwargs)[0]
 
+    def random_keys(self, count: int, features=None) -> list:
+        """
+        `count` distinct random keys, weighted by coverage like `choose`.
+        """
+        if self._guided(features):
+            return self.coverage.sample(self.rng, self.candidates(), count, features)
+        return self.candidates().sample(self.rng, count)
+
     """
     sortable: key types where operations like `<` are well-defined (e.g. text, but not keywords)
     numeric: any number types
     time: only allow the time type
     prefer_forced: if there exists forced keys in the context, choose from them.
     Generally used by the caller to conditionally avoid dropping a forced field from the context.
+    parse: keys with a parser
+    renamable: keys with a `rename_target`
+    feature: command the key is for, so an adaptive coverage tracker can favour field types the
+    command hasn't been used with (see `field_feature`)
     """
-    def random_item(self, sortable=False, numeric=False, time=False, prefer_forced=False, parse=False):
-        items = list(self.items())
-        if sortable:
-            items = [(k, v) for k, v in items if v["type"] in ("text", "int", "float", "time")]
-        if numeric:
-            items = [(k, v) for k, v in items if v["type"] in ("float", "int")]
-        if time:
-            items = [(k, v) for k, v in items if v["type"] == "time"]
+    def random_item(
+        self,
+        sortable=False,
+        numeric=False,
+        time=False,
+        prefer_forced=False,
+        parse=False,
+        renamable=False,
+        feature: str | None = None,
+    ):
+        candidates = self.candidates(sortable, numeric, time, prefer_forced, parse, renamable)
+        if self._guided(feature):
+            key = self.coverage.choose(
+                self.rng, candidates, lambda key: (field_feature(feature, self[key]["type"]),)
+            )
+        else:
+            key = candidates.choice(self.rng)
+        return key, self[key]
+
+    def candidates(
+        self, sortable=False, numeric=False, time=False, prefer_forced=False, parse=False, renamable=False
+    ) -> KeyIndex:
+        """
+        Keys matching all the given filters (see `random_item`). A single filter is answered
+        straight from its index; combined filters intersect starting from the smallest index.
+        """
+        indexes = [
+            self._indexes[name]
+            for name, enabled in (
+                ("sortable", sortable),
+                ("numeric", numeric),
+                ("time", time),
+                ("parse", parse),
+                ("renamable", renamable),
+            )
+            if enabled
+        ]
         if prefer_forced and len(self.forced_fields) > 0:
-            items = [(k, v) for k, v in items if k in self.forced_fields]
-        if parse:
-            items = [(k, v) for k, v in items if "parser" in v]
-        return random.choice(items)
+            indexes.append(self.forced_fields)
+        if not indexes:
+            return self._indexes["all"]
+        if len(indexes) == 1:
+            return indexes[0]
+        smallest = min(indexes, key=len)
+        return KeyIndex(k for k in smallest if all(k in index for index in indexes))
 
     def sample_value(self, key):
         props = self[key]
+        if self.literals is not None:
+            return self.literals.sample(props)
         match props["type"]:
             case "keyword" | "text":
-                return repr(random.choice(props["values"]))
+                return self.rng.choice(props["value_reprs"])
             case "int":
-                return repr(random.randint(int(props["min"]), int(props["max"])))
+                return repr(self.rng.randint(int(props["min"]), int(props["max"])))
             case "float":
-                return repr(round(random.random() * (props["max"] - props["min"]) + props["min"], 1))
+                return repr(round(self.rng.random() * (props["max"] - props["min"]) + props["min"], 1))
             case "list":
                 # TODO this probably needs better handling but it's not clear what lists
                 # actually do
-                return repr(random.choice(props["items"]))
+                return self.rng.choice(props["item_reprs"])
             case "time":
-                tmin, tmax = (
-                    datetime.datetime.fromisoformat(props["min"]),
-                    datetime.datetime.fromisoformat(props["max"]),
-                )
-
-                stime, etime = (
-                    tmin.timestamp(),
-                    tmax.timestamp(),
-                )
-                prop = random.random()
+                stime, etime = props["min_epoch"], props["max_epoch"]
+                prop = self.rng.random()
                 ptime = stime + prop * (etime - stime)
-                result_time = datetime.datetime.fromtimestamp(ptime)
-                result = result_time.strftime("%Y-%m-%d %H:%M:%S")
+                result = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ptime))
 
                 return f"TIMESTAMP('{result}')"
             case "bool":
-                return str(random.random() > 0.5).lower()
+                return str(self.rng.random() > 0.5).lower()
             case unknown:
                 raise ValueError(f"Unknown prop type: {unknown}")
 
@@ -92,62 +401,52 @@ class QueryContext(dict):
         """
         props = self[key]
         sample_value = self.sample_value(key)
-        match props["type"]:
+        field_type = props["type"]
+        op = self.choose(OPERATORS[field_type], lambda op: (where_feature(field_type, op),))
+        match field_type:
             case "keyword":
-                op = random.choice(["=", "!=", "IN"])
                 if op == "IN":
                     if len(props["values"]) == 1:
                         # If there's only one value, IN is functionally equiv. to =
                         op = "="
+                    elif self.literals is not None:
+                        sample_value = self.literals.sample_in_tuple(props)
                     else:
                         # Otherwise, generate a random tuple of 2+ elements from available values
                         sample_value = repr(
                             tuple(
-                                random.sample(
+                                self.rng.sample(
                                     props["values"],
-                                    random.randint(2, min(len(props["values"]), 4)),
+                                    self.rng.randint(2, min(len(props["values"]), 4)),
                                 )
                             )
                         )
-                return f"{key} {op} {sample_value}"
+                expr = f"{key} {op} {sample_value}"
             case "text":
-                op = random.choice(["=", ">", ">=", "<", "<=", "LIKE"])
                 if len(sample_value) > 20:
                     op = "LIKE" # Equality checking for large strings gets messy fast
                 if op == "LIKE":
-                    idx = random.randint(2, 20)
+                    idx = self.rng.randint(2, 20)
                     # For now, only prefix or suffix is counted
                     sample_value = repr(
-                        random.choice([sample_value[0:idx] + "%", "%" + sample_value[-idx:]])
+                        self.rng.choice([sample_value[0:idx] + "%", "%" + sample_value[-idx:]])
                     )
-                return f"{key} {op} {sample_value}" if op != "LIKE" else f"LIKE({key}, {sample_value})"
-            case "int":
-                op = random.choice(["=", "!=", ">", ">=", "<", "<="])
-                return f"{key} {op} {sample_value}"
-            case "float":
-                op = random.choice(["=", "!=", ">", ">=", "<", "<="])
-                return f"{key} {op} {sample_value}"
-            case "list":
-                # It's not entirely clear what list operations are supported, but '=' and '!=' at
-                # least cover CONTAINS/NOT CONTAINS
-                op = random.choice(["=", "!="])
-                return f"{key} {op} {sample_value}"
-            case "time":
-                op = random.choice(["=", ">", ">=", "<", "<="])
-                return f"{key} {op} {sample_value}"
+                expr = f"{key} {op} {sample_value}" if op != "LIKE" else f"LIKE({key}, {sample_value})"
+            case "int" | "float" | "list" | "time":
+                expr = f"{key} {op} {sample_value}"
             case "bool":
-                return random.choice([key, f"NOT {key}"])
-            case unknown:
-                raise ValueError(f"Unknown prop type: {unknown}")
+                expr = f"NOT {key}" if op == "NOT" else key
+        self.cover(where_feature(field_type, op))
+        return expr
 
 
     def filter_to(self, keys):
-        old_keys = list(self.keys())
-        for key in old_keys:
-            if key not in keys and key in self.forced_fields:
+        keep = set(keys)
+        for key in list(self):
+            if key not in keep and key in self.forced_fields:
                 raise ValueError(f"Attempted to filter a forced field: key '{key}' is forced in {self.forced_fields} but not in {keys}")
-            if key not in keys:
+            if key not in keep:
                 del self[key]
 
     def clear(self, keep_forced=False):
-        self.filter_to([] if not keep_forced else list(self.force_fields))
+        self.filter_to([] if not keep_forced else list(self.forced_fields))
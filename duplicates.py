@@ -0,0 +1,64 @@
+"""
+Suppression of repeated queries between generation and verification. Small schemas produce the
+same query over and over, and each repeat costs a round trip to the cluster. Queries are reduced
+to a canonical form and checked against a Bloom filter, so memory stays fixed no matter how many
+queries a run generates.
+"""
+
+import ast
+import re
+from query_cache import LITERAL_RE, normalize_query
+from sketches import BloomFilter
+
+# Decimal numbers outside of literals and names, e.g. `1.50` in `where x > 1.50`
+DECIMAL_RE = re.compile(r"(?<![\w.])\d+\.\d*(?:[eE][-+]?\d+)?(?![\w.])")
+
+
+def canonical_query(ppl_query: str) -> str:
+    """
+    Form of a query that's the same for queries differing only in whitespace outside literals,
+    quoting of string literals (`"a"` and `'a'`), or formatting of decimals (`1.50` and `1.5`).
+    """
+    normalized = normalize_query(ppl_query)
+    canonical_decimal = lambda match: repr(float(match.group()))
+    parts, pos = [], 0
+    for match in LITERAL_RE.finditer(normalized):
+        parts.append(DECIMAL_RE.sub(canonical_decimal, normalized[pos : match.start()]))
+        literal = match.group()
+        if literal[0] != "`":
+            try:
+                literal = repr(ast.literal_eval(literal))
+            except (ValueError, SyntaxError):
+                pass
+        parts.append(literal)
+        pos = match.end()
+    parts.append(DECIMAL_RE.sub(canonical_decimal, normalized[pos:]))
+    return "".join(parts)
+
+
+class DuplicateFilter:
+    """
+    Pipeline stage dropping queries already seen in this run. At most about `error_rate` of
+    unique queries are dropped by mistake, as long as the run has no more than `capacity` unique
+    queries.
+    """
+
+    def __init__(self, capacity: int = 10_000_000, error_rate: float = 0.001):
+        self.seen = BloomFilter(capacity, error_rate)
+        self.total = 0
+        self.duplicates = 0
+
+    def filter(self, ppl_queries):
+        for ppl_query in ppl_queries:
+            self.total += 1
+            if self.seen.add(canonical_query(ppl_query)):
+                self.duplicates += 1
+            else:
+                yield ppl_query
+
+    def summary(self) -> str:
+        rate = self.duplicates / self.total if self.total > 0 else 0.0
+        summary = f"Duplicates: {self.duplicates} of {self.total} queries dropped ({rate:.1%} duplicate rate)"
+        if self.seen.count > self.seen.capacity:
+            summary += f", filter over capacity with a {self.seen.error_rate:.2%} false positive rate"
+        return summary
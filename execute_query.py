@@ -0,0 +1,629 @@
+"""
+In-process reference executor for the PPL produced by gen_queries.py, for differential testing
+against a cluster. Sample records are loaded once into NumPy columns, and each command of a query
+is evaluated as whole-column operations over them.
+
+The semantics follow OpenSearch PPL where they matter for comparing results: comparisons are
+false for nulls, `LIKE` is case-insensitive, ascending sorts put nulls first, `stats` groups are
+ordered by key, and `top`/`rare` put the `by` fields first.
+
+With `--compare`, each query is also run on the cluster in `client_conf.json`, and queries whose
+local result differs from the cluster's (or that only one side rejects) are printed as JSON lines.
+Queries taking `head` rows before any `sort` are skipped, since which rows they get depends on the
+cluster's document order.
+
+Usage: execute_query.py [data file...] [--compare] < queries.txt
+"""
+
+import argparse
+import ast
+import json
+import operator
+import re
+import sys
+import numpy as np
+from collections import Counter
+from context import TIME_PARTS
+from make_schema import classify, iter_records, parse_time, scan_record
+from validate_query import InvalidQuery, SegmentChecker, split_segments
+
+COMPARISON_OPS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+# Default number of rows for `head`, and of values per group for `top` and `rare`
+DEFAULT_LIMIT = 10
+
+
+class RecordColumns:
+    """
+    Collects flattened records into one list per field, padding fields missing from a record
+    with None so every list stays the same length.
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.row_count = 0
+
+    def add_value(self, key, value):
+        if key not in self.columns:
+            self.columns[key] = [None] * self.row_count
+        self.columns[key].append(value)
+
+    def add_record(self, record):
+        scan_record(record, self)
+        self.row_count += 1
+        for values in self.columns.values():
+            if len(values) < self.row_count:
+                values.append(None)
+
+
+def to_column(values: list) -> np.ndarray:
+    """
+    Convert a field's values to the most specific array type that holds all of them: int64 or
+    float64 (NaN for nulls) for numbers, datetime64[ms] (NaT for nulls) for times, bool, str, or
+    object.
+    """
+    type_counts = Counter(classify(v)[0] for v in values if v is not None)
+    types = set(type_counts)
+    has_nulls = len(values) > type_counts.total()
+    if types == {"int"} and not has_nulls:
+        return np.array(values, dtype=np.int64)
+    if types and types <= {"int", "float"}:
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    if types == {"time"} or (types == {"time", "str"} and type_counts["time"] > type_counts["str"]):
+        # Like make_schema, a mostly-time field is a time field. Malformed times are dropped the way
+        # the cluster drops them for a date mapping, as nulls.
+        epochs = [None if v is None else parse_time(v) for v in values]
+        return np.array(["NaT" if e is None else round(e * 1000) for e in epochs], dtype="datetime64[ms]")
+    if types == {"bool"} and not has_nulls:
+        return np.array(values, dtype=bool)
+    if types == {"str"} and not has_nulls:
+        # Fixed width strings sort and compare in NumPy instead of per value in Python
+        return np.array(values, dtype=str)
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def load_table(paths) -> dict[str, np.ndarray]:
+    collector = RecordColumns()
+    for path in paths:
+        for record in iter_records(path):
+            collector.add_record(record)
+    return {key: to_column(values) for key, values in collector.columns.items()}
+
+
+def not_null(column: np.ndarray) -> np.ndarray:
+    match column.dtype.kind:
+        case "f":
+            return ~np.isnan(column)
+        case "M":
+            return ~np.isnat(column)
+        case "O":
+            return np.fromiter((v is not None for v in column), dtype=bool, count=len(column))
+        case _:
+            return np.ones(len(column), dtype=bool)
+
+
+def sort_keys(column: np.ndarray) -> np.ndarray:
+    """
+    An array ordering the same way as the non-null values of `column`, that `np.argsort` can sort.
+    """
+    if column.dtype.kind in "Mb":
+        return column.astype(np.int64)
+    if column.dtype.kind == "U":
+        # Ranks rather than the strings themselves, so descending sorts can negate them
+        return np.unique(column, return_inverse=True)[1].reshape(-1)
+    if column.dtype.kind == "O":
+        # Rank the values in Python, since object arrays with mixed types can't be compared
+        ranks = {v: i for i, v in enumerate(sorted(set(map(hashable, column)), key=mixed_key))}
+        return np.fromiter((ranks[hashable(v)] for v in column), dtype=np.int64, count=len(column))
+    return column
+
+
+def hashable(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+def mixed_key(value):
+    # Orders values of different types by type first, with nulls before everything
+    return (value is not None, type(value).__name__, value)
+
+
+def factorize(columns: list[np.ndarray], n: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Group `n` rows by the values of `columns`. Returns the group of each row, and the first row of
+    each group. Groups are numbered in order of their key values, with nulls first.
+    """
+    if not columns:
+        return np.zeros(n, dtype=np.int64), np.zeros(min(n, 1), dtype=np.int64)
+    codes = []
+    for column in columns:
+        present = not_null(column)
+        keys = sort_keys(column)
+        uniques, inverse = np.unique(keys[present], return_inverse=True)
+        code = np.zeros(n, dtype=np.int64)
+        code[present] = inverse.reshape(-1) + 1
+        codes.append(code)
+    _, first_rows, groups = np.unique(np.stack(codes, axis=1), axis=0, return_index=True, return_inverse=True)
+    return groups.reshape(-1), first_rows
+
+
+class SegmentExecutor(SegmentChecker):
+    """
+    Evaluates a single command over a table, reusing SegmentChecker's parsing. `fields` holds the
+    table's columns instead of their types.
+    """
+
+    def __init__(self, tokens, table: dict[str, np.ndarray]):
+        # Commands like rename modify the fields in place, so don't share them with the input
+        super().__init__(tokens, dict(table))
+
+    @property
+    def row_count(self):
+        return len(next(iter(self.fields.values()))) if self.fields else 0
+
+    def take(self, rows):
+        self.fields = {name: column[rows] for name, column in self.fields.items()}
+
+    def literal_value(self):
+        kind, text = self.next()
+        if kind == "string":
+            return ast.literal_eval(text)
+        if kind == "number":
+            return ast.literal_eval(text)
+        if kind == "name" and text.lower() in ("true", "false"):
+            return text.lower() == "true"
+        if kind == "name" and text.upper() == "TIMESTAMP":
+            self.expect("(")
+            _, text = self.next()
+            self.expect(")")
+            epoch = parse_time(ast.literal_eval(text))
+            if epoch is None:
+                raise InvalidQuery(f"invalid timestamp {text}")
+            return np.datetime64(round(epoch * 1000), "ms")
+        raise InvalidQuery(f"expected a literal, found {text!r}")
+
+    # Boolean expressions, for `where`. NOT binds tightest, then AND, XOR and OR.
+
+    def expression(self):
+        mask = self.xor_expression()
+        while self.accept("OR"):
+            mask = mask | self.xor_expression()
+        return mask
+
+    def xor_expression(self):
+        mask = self.and_expression()
+        while self.accept("XOR"):
+            mask = mask ^ self.and_expression()
+        return mask
+
+    def and_expression(self):
+        mask = self.predicate()
+        while self.accept("AND"):
+            mask = mask & self.predicate()
+        return mask
+
+    def predicate(self):
+        if self.accept("NOT"):
+            return ~self.predicate()
+        if self.accept("("):
+            mask = self.expression()
+            self.expect(")")
+            return mask
+        if self.peek()[1] is not None and self.peek()[1].upper() == "LIKE" and self.peek(1)[1] == "(":
+            self.pos += 2
+            column = self.fields[self.field()]
+            self.expect(",")
+            pattern = like_regex(self.literal_value())
+            self.expect(")")
+            return np.fromiter(
+                (isinstance(v, str) and pattern.fullmatch(v) is not None for v in column), dtype=bool, count=len(column)
+            )
+
+        column = self.fields[self.field()]
+        kind, op = self.peek()
+        if kind == "op" and op in COMPARISON_OPS:
+            self.pos += 1
+            return compare(column, op, self.literal_value())
+        if self.accept("IN"):
+            self.expect("(")
+            values = [self.literal_value()]
+            while self.accept(","):
+                values.append(self.literal_value())
+            self.expect(")")
+            present = not_null(column)
+            mask = np.zeros(len(column), dtype=bool)
+            mask[present] = np.isin(column[present], np.array(values, dtype=object if column.dtype.kind == "O" else None))
+            return mask
+        return np.fromiter((v is True or v is np.True_ for v in column), dtype=bool, count=len(column))
+
+    # Commands
+
+    def where(self):
+        self.take(self.expression())
+
+    def sort(self):
+        keys = []
+        while True:
+            descending = self.accept("-")
+            if not descending:
+                self.accept("+")
+            keys.append((self.field(), descending))
+            if not self.accept(","):
+                break
+        rows = np.arange(self.row_count)
+        # Stable sorts from the last key to the first give a lexicographic sort
+        for name, descending in reversed(keys):
+            column = self.fields[name][rows]
+            present = not_null(column)
+            values = sort_keys(column)[present]
+            order = np.argsort(-values if descending else values, kind="stable")
+            if descending:
+                rows = np.concatenate([rows[present][order], rows[~present]])
+            else:
+                rows = np.concatenate([rows[~present], rows[present][order]])
+        self.take(rows)
+
+    def dedup(self):
+        count = 1
+        if self.peek()[0] == "number":
+            count = int(self.next()[1])
+        names = self.field_list()
+        columns = [self.fields[name] for name in names]
+        present = np.logical_and.reduce([not_null(c) for c in columns])
+        groups, _ = factorize(columns, self.row_count)
+        # Keep the first `count` rows of each group (rows with nulls are dropped), in their original order
+        rows = np.flatnonzero(present)
+        order = np.argsort(groups[rows], kind="stable")
+        ranks = np.empty(len(rows), dtype=np.int64)
+        ranks[order] = rank_within(groups[rows][order])
+        self.take(np.sort(rows[ranks < count]))
+
+    def rename(self):
+        renames = {}
+        while True:
+            name = self.field()
+            self.expect("as")
+            renames[name] = self.new_name()
+            if not self.accept(","):
+                break
+        # Renamed fields keep their position
+        self.fields = {renames.get(name, name): column for name, column in self.fields.items()}
+
+    def head(self):
+        count = DEFAULT_LIMIT
+        if self.peek()[0] == "number":
+            count = int(self.next()[1])
+        self.take(slice(0, count))
+
+    def top_rare(self, allow_count):
+        count = DEFAULT_LIMIT
+        if allow_count and self.peek()[0] == "number":
+            count = int(self.next()[1])
+        names = self.field_list()
+        by = self.field_list() if self.accept("by") else []
+
+        present = np.logical_and.reduce([not_null(self.fields[name]) for name in names])
+        self.take(present)
+        by_groups, _ = factorize([self.fields[name] for name in by], self.row_count)
+        groups, first_rows = factorize([self.fields[name] for name in by + names], self.row_count)
+        counts = np.bincount(groups, minlength=len(first_rows))
+        # Within each `by` group, order values by count (most common first for top), then by value
+        group_by = by_groups[first_rows]
+        order = np.lexsort((np.arange(len(first_rows)), counts if not allow_count else -counts, group_by))
+        rows = first_rows[order][rank_within(group_by[order]) < count]
+        self.fields = {name: self.fields[name][rows] for name in by + names}
+
+    def stats(self):
+        aggs = []
+        while True:
+            func = self.next()[1]
+            self.expect("(")
+            if func.lower() == "count" and self.accept(")"):
+                aggs.append(("count()", "count", None))
+            else:
+                name = self.field()
+                self.expect(")")
+                aggs.append((f"{func}({name})", func.lower(), name))
+            if not self.accept(","):
+                break
+        by = self.field_list() if self.accept("by") else []
+
+        groups, first_rows = factorize([self.fields[name] for name in by], self.row_count)
+        # Without `by` there's always exactly one row, even over no input
+        group_count = len(first_rows) if by else 1
+        output = {}
+        for label, func, name in aggs:
+            output[label] = aggregate(func, None if name is None else self.fields[name], groups, group_count)
+        for name in by:
+            output[name] = self.fields[name][first_rows]
+        self.fields = output
+
+    def eval_cmd(self):
+        new_name = self.new_name()
+        self.expect("=")
+        func = self.next()[1].upper()
+        if func not in TIME_PARTS:
+            raise InvalidQuery(f"unsupported eval expression {func!r}")
+        self.expect("(")
+        column = self.fields[self.field()]
+        self.expect(")")
+        self.fields[new_name] = time_part(func, column)
+
+    def parse(self):
+        column = self.fields[self.field()]
+        pattern = re.compile(re.sub(r"\(\?<(?![=!])", "(?P<", self.literal_value()))
+        matches = [pattern.match(v) if isinstance(v, str) else None for v in column]
+        for group in pattern.groupindex:
+            # Rows the pattern doesn't match parse to an empty string
+            parsed = [m.group(group) or "" if m is not None else "" for m in matches]
+            self.fields[group] = np.array(parsed, dtype=str)
+
+
+def rank_within(sorted_groups: np.ndarray) -> np.ndarray:
+    """
+    Position of each element within its run of equal values, e.g. [5, 5, 7, 9, 9, 9] -> [0, 1, 0, 0, 1, 2].
+    """
+    if len(sorted_groups) == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    run_lengths = np.diff(np.r_[starts, len(sorted_groups)])
+    return np.arange(len(sorted_groups)) - np.repeat(starts, run_lengths)
+
+
+def like_regex(pattern: str) -> re.Pattern:
+    parts = []
+    for char in pattern:
+        parts.append(".*" if char == "%" else "." if char == "_" else re.escape(char))
+    return re.compile("".join(parts), re.IGNORECASE | re.DOTALL)
+
+
+def compare(column: np.ndarray, op: str, value) -> np.ndarray:
+    present = not_null(column)
+    mask = np.zeros(len(column), dtype=bool)
+    values = column[present]
+    if column.dtype.kind == "M" and isinstance(value, str):
+        epoch = parse_time(value)
+        if epoch is None:
+            raise InvalidQuery(f"can't compare a time field with {value!r}")
+        value = np.datetime64(round(epoch * 1000), "ms")
+    if column.dtype.kind == "U" and not isinstance(value, str):
+        return mask
+    if column.dtype.kind in "iufb" and isinstance(value, str):
+        raise InvalidQuery(f"can't compare a {column.dtype} field with {value!r}")
+    if column.dtype.kind == "O":
+        # List fields compare by containment: `=` is CONTAINS and `!=` is NOT CONTAINS
+        fn = COMPARISON_OPS[op]
+        mask[present] = [
+            (value in v) == (op == "=") if isinstance(v, list) else type(v) is type(value) and fn(v, value)
+            for v in values
+        ]
+        return mask
+    try:
+        mask[present] = COMPARISON_OPS[op](values, value)
+    except TypeError:
+        # e.g. a string literal against a numeric field, which the cluster rejects too
+        raise InvalidQuery(f"can't compare a {column.dtype} field with {value!r}")
+    return mask
+
+
+def aggregate(func: str, column: np.ndarray | None, groups: np.ndarray, group_count: int) -> np.ndarray:
+    if column is None:
+        return np.bincount(groups, minlength=group_count)
+    present = not_null(column)
+    counts = np.bincount(groups[present], minlength=group_count)
+    if func == "count":
+        return counts
+    is_time = column.dtype.kind == "M"
+    values = column[present].astype(np.int64 if is_time else np.float64)
+    if func == "sum":
+        sums = np.bincount(groups[present], weights=values, minlength=group_count)
+        return sums.astype(np.int64) if column.dtype.kind == "i" else sums
+    if func == "avg":
+        sums = np.bincount(groups[present], weights=values, minlength=group_count)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    if func in ("min", "max"):
+        fill = np.inf if func == "min" else -np.inf
+        result = np.full(group_count, fill)
+        (np.minimum if func == "min" else np.maximum).at(result, groups[present], values)
+        result[counts == 0] = np.nan
+        if is_time:
+            out = np.full(group_count, np.datetime64("NaT"), dtype="datetime64[ms]")
+            out[counts > 0] = result[counts > 0].astype(np.int64).astype("datetime64[ms]")
+            return out
+        if column.dtype.kind == "i" and (counts > 0).all():
+            return result.astype(np.int64)
+        return result
+    raise InvalidQuery(f"unknown aggregation {func!r}")
+
+
+def time_part(func: str, column: np.ndarray) -> np.ndarray:
+    if column.dtype.kind != "M":
+        raise InvalidQuery(f"{func} on a non-time field")
+    present = not_null(column)
+    years = column.astype("datetime64[Y]")
+    months = column.astype("datetime64[M]")
+    days = column.astype("datetime64[D]")
+    day_of_year = (days - years).astype(np.int64) + 1
+    # 1970-01-01 was a Thursday; DAY_OF_WEEK counts from Sunday = 1
+    day_of_week = (days.astype(np.int64) + 4) % 7 + 1
+    match func:
+        case "SECOND":
+            result = (column - column.astype("datetime64[m]")).astype("timedelta64[s]").astype(np.int64)
+        case "MINUTE":
+            result = (column.astype("datetime64[m]") - column.astype("datetime64[h]")).astype(np.int64)
+        case "HOUR":
+            result = (column.astype("datetime64[h]") - days).astype(np.int64)
+        case "DAY":
+            result = (days - months).astype(np.int64) + 1
+        case "WEEK":
+            # Week 1 starts on the first Sunday of the year, days before it are week 0
+            jan1_day_of_week = (years.astype("datetime64[D]").astype(np.int64) + 4) % 7
+            first_sunday = 1 + (7 - jan1_day_of_week) % 7
+            result = np.where(day_of_year < first_sunday, 0, (day_of_year - first_sunday) // 7 + 1)
+        case "MONTH":
+            result = (months - years).astype(np.int64) + 1
+        case "YEAR":
+            result = years.astype(np.int64) + 1970
+        case "DAY_OF_WEEK":
+            result = day_of_week
+        case "DAY_OF_YEAR":
+            result = day_of_year
+    if present.all():
+        return result
+    return np.where(present, result, np.nan)
+
+
+def execute(ppl_query: str, table: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """
+    Run a query over a table from `load_table`, returning the resulting columns. Raises
+    InvalidQuery for queries that can't run, e.g. referencing a missing field.
+    """
+    for command, tokens in split_segments(ppl_query):
+        if command not in COMMANDS:
+            raise InvalidQuery(f"unknown command {command!r}")
+        executor = SegmentExecutor(tokens, table)
+        COMMANDS[command](executor)
+        executor.done()
+        table = executor.fields
+    return table
+
+
+COMMANDS = {
+    "where": SegmentExecutor.where,
+    "fields": SegmentExecutor.fields_cmd,
+    "rename": SegmentExecutor.rename,
+    "sort": SegmentExecutor.sort,
+    "dedup": SegmentExecutor.dedup,
+    "head": SegmentExecutor.head,
+    "top": lambda executor: executor.top_rare(allow_count=True),
+    "rare": lambda executor: executor.top_rare(allow_count=False),
+    "stats": SegmentExecutor.stats,
+    "eval": SegmentExecutor.eval_cmd,
+    "parse": SegmentExecutor.parse,
+}
+
+
+def to_json_column(column: np.ndarray) -> list:
+    """
+    Values of a column formatted like the cluster's PPL response, with nulls as None.
+    """
+    present = not_null(column)
+    if column.dtype.kind == "M":
+        values = [v.replace("T", " ") for v in column.astype("datetime64[s]").astype(str).tolist()]
+    else:
+        values = column.tolist()
+    if present.all():
+        return values
+    return [v if p else None for v, p in zip(values, present.tolist())]
+
+
+def to_datarows(table: dict[str, np.ndarray]) -> list[list]:
+    """
+    Rows of a result table, with values formatted like the cluster's PPL response `datarows`.
+    """
+    return [list(row) for row in zip(*(to_json_column(column) for column in table.values()))]
+
+
+def same_result(table: dict[str, np.ndarray], response: dict, ordered: bool = False) -> bool:
+    """
+    Compare a local result with a PPL response from the cluster. Unless `ordered`, rows are compared
+    as a multiset, since the order of rows is only defined after `sort`.
+    """
+    names = [column["name"] for column in response["schema"]]
+    if sorted(table) != sorted(names):
+        return False
+    # Integer fields with nulls are float columns locally, so numbers are compared as floats
+    normalize = lambda row: [
+        round(float(v), 6) if isinstance(v, (int, float)) and not isinstance(v, bool) else v for v in row
+    ]
+    # Column order without `fields` depends on the index mapping, so compare in the response's order
+    local = [normalize(row) for row in to_datarows({name: table[name] for name in names})]
+    remote = [normalize(row) for row in response["datarows"]]
+    if ordered:
+        return local == remote
+    as_key = lambda row: json.dumps(row, sort_keys=True, default=str)
+    return sorted(map(as_key, local)) == sorted(map(as_key, remote))
+
+
+def order_dependent(ppl_query: str) -> bool:
+    # `head` before any `sort` keeps whichever rows come first, which differs between executors
+    for command, _ in split_segments(ppl_query):
+        if command == "sort":
+            return False
+        if command == "head":
+            return True
+    return False
+
+
+def compare_all(table: dict[str, np.ndarray], ppl_queries, max_in_flight: int):
+    """
+    Run each query locally and on the cluster, printing a JSON line for every query whose results
+    differ. Reports how many matched on stderr.
+    """
+    from verify_query import make_client, run_ppl_queries
+
+    client = make_client(pool_maxsize=max_in_flight)
+    compared, mismatched, skipped = 0, 0, 0
+    for ppl_query, remote in run_ppl_queries(client, ppl_queries, max_in_flight):
+        try:
+            if order_dependent(ppl_query):
+                skipped += 1
+                continue
+            local, local_error = execute(ppl_query, table), None
+        except InvalidQuery as e:
+            local, local_error = None, str(e)
+        compared += 1
+        if local is not None and remote["success"]:
+            if same_result(local, remote["response"]):
+                continue
+            mismatch = {"local": {"schema": list(local), "datarows": to_datarows(local)}, "cluster": remote["response"]}
+        elif local is None and not remote["success"]:
+            # Both reject the query
+            continue
+        else:
+            mismatch = {"local_error": local_error, "cluster_error": remote["error"]}
+        mismatched += 1
+        print(json.dumps({"query": ppl_query, **mismatch}, default=str), flush=True)
+    print(
+        f"Compared {compared} queries: {compared - mismatched} matched, {mismatched} differed, "
+        f"{skipped} skipped as order dependent",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run PPL queries over sample data in-process.")
+    parser.add_argument("data", nargs="+", help="sample data files the queries run over")
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="also run each query on the cluster in client_conf.json, and print the ones whose results differ",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=8,
+        help="with --compare, maximum number of requests outstanding at once (default 8)",
+    )
+    args = parser.parse_args()
+    if args.max_in_flight < 1:
+        parser.error("--max-in-flight must be at least 1")
+    table = load_table(args.data)
+    ppl_queries = (line.strip() for line in sys.stdin if line.strip())
+    if args.compare:
+        compare_all(table, ppl_queries, args.max_in_flight)
+    else:
+        for ppl_query in ppl_queries:
+            try:
+                result = execute(ppl_query, table)
+                print(json.dumps({"query": ppl_query, "schema": list(result), "datarows": to_datarows(result)}))
+            except InvalidQuery as e:
+                print(f"Encountered error:\n> Query: {ppl_query}\n> Error: {e}", file=sys.stderr)
@@ -1,164 +1,147 @@
+import argparse
 import json
 import sys
 import random
-import re
-from typing import Any
-from context import QueryContext
+import time
+from concurrent.futures import ProcessPoolExecutor
+from compile_schema import load_schema
+from context import (
+    INDEX_PREDICATES,
+    OPERATORS,
+    TIME_PARTS,
+    QueryContext,
+    Schema,
+    field_feature,
+    rename_target,
+    where_feature,
+)
+from duplicates import DuplicateFilter
 from functools import reduce
-from verify_query import make_client, verify
-
-
-class Retry(Exception):
-    """
-    Custom type to abort a generation attempt and retry from scratch. Retry must only be raised if
-    context is still in its original state: do not modify context before retry.
-    """
-
-    pass
+from grammar_coverage import CoverageTracker
+from literals import LiteralSampler, seeded_generator
+from metrics import GenerationMetrics
+from pipeline import bounded_map
+from query_cache import ResultCache, cluster_identity
+from sink import COMPRESSIONS, ShardedWriter, query_record
+from validate_query import validate_all
+from verify_query import VERIFY_MODES, make_client, verify_all
 
 
 def dedup(context: QueryContext):
-    key = context.random_key()
+    key, props = context.random_item(feature="dedup")
+    context.cover(field_feature("dedup", props["type"]))
     return f"dedup {key}"
 
 
 def eval_cmd(context: QueryContext):
     # TODO handle more than just time evals
-    try:
-        key = context.random_key(time=True)
-    except IndexError:
-        raise Retry()
-    
-    func_parts = {
-        "SECOND": ("second", 0, 59),
-        "MINUTE": ("minute", 0, 59),
-        "HOUR": ("hour", 0, 59),
-        "DAY": ("day", 1, 31),
-        "WEEK": ("week", 1, 52),
-        "MONTH": ("month", 1, 12),
-        "YEAR": ("year", 1970, 2024),
-        "DAY_OF_WEEK": ("day", 1, 7),
-        "DAY_OF_YEAR": ("day", 1, 366)
-    }
-    part, (var, vmin, vmax) = random.choice(list(func_parts.items()))
-    context[var] = {
-        "type": "int",
-        "min": vmin,
-        "max": vmax,
-        "nullable": False,
-        "unique": False,
-    }
+    key = context.random_key(time=True)
+
+    part, (var, _, _) = context.rng.choice(list(TIME_PARTS.items()))
+    context[var] = EVAL_FIELD_PROPS[part]
 
     context.forced_fields.add(var)
 
     return f"eval {var} = {part}({key})"
 
 
+# Properties of the fields `eval` adds, shared between queries rather than building a new dict for
+# every `eval`.
+EVAL_FIELD_PROPS = {
+    part: {"type": "int", "min": vmin, "max": vmax, "nullable": False, "unique": False}
+    for part, (_, vmin, vmax) in TIME_PARTS.items()
+}
+
+
 def fields(context: QueryContext):
     keys = list(context.keys())
-    take_count = random.randint(1, min(5, len(context)))
-    fields = random.sample(keys, take_count)
+    take_count = context.rng.randint(1, min(5, len(context)))
+    fields = context.rng.sample(keys, take_count)
     # Require forced fields
-    fields = sorted(set(fields) | context.forced_fields)
+    fields = sorted(set(fields).union(context.forced_fields))
 
     context.filter_to(fields)
 
     return f"fields {', '.join(fields)}"
 
 
-def head(_context: QueryContext):
-    return random.choice(["head 1", "head 5", "head", "head 20", "head 50"])
+def head(context: QueryContext):
+    return context.rng.choice(["head 1", "head 5", "head", "head 20", "head 50"])
 
 
 def parse(context: QueryContext):
     key, params = context.random_item(parse=True)
     parser = params["parser"]
-    context.forced_fields.add(parser["fields"][0])
     for field in parser["fields"]:
-        matches = [re.match(parser["pattern"], v) for v in params["values"]]
-        context[field] = {
-            "type": params["type"],
-            "values": [m.group(field) for m in matches],
-            "nullable": False,
-            "unique": False,
-        }
-    # Convert from python regex dialect for group to PPL dialect
-    repr_re = repr(parser['pattern'].replace('?P<', '?<'))
-    return f"parse {key} {repr_re}"
+        context[field] = parser["field_props"][field]
+    context.forced_fields.add(parser["fields"][0])
+    return f"parse {key} {parser['ppl_pattern']}"
 
 def rare(context: QueryContext):
-    key = context.random_key()
+    key = context.random_key(feature="rare")
     by = context.random_key(prefer_forced=True)
-    if by != key and random.random() < 0.75:
+    if by != key and context.rng.random() < 0.75:
+        context.cover(field_feature("rare", context[key]["type"]))
         context.filter_to([key, by])
         return f"rare {key} by {by}"
     if by != key and by in context.forced_fields:
         key = by
+    context.cover(field_feature("rare", context[key]["type"]))
     context.filter_to([key])
     return f"rare {key}"
 
 
 def top(context: QueryContext):
-    top = random.choice(["top 1", "top 5", "top", "top 20", "top 50"])
-    key = context.random_key()
+    top = context.rng.choice(["top 1", "top 5", "top", "top 20", "top 50"])
+    key = context.random_key(feature="top")
     by = context.random_key(prefer_forced=True)
-    if by != key and random.random() < 0.75:
+    if by != key and context.rng.random() < 0.75:
+        context.cover(field_feature("top", context[key]["type"]))
         context.filter_to([key, by])
         return f"{top} {key} by {by}"
     if by != key and by in context.forced_fields:
         key = by
+    context.cover(field_feature("top", context[key]["type"]))
     context.filter_to([key])
     return f"{top} {key}"
 
 
 def rename(context: QueryContext):
-    key = context.random_key()
-    unquoted = key.strip("`")
-    tail = re.split(r"(_|[^\w])", unquoted)[-1]
-    if tail == unquoted:
-        raise Retry()
+    key = context.random_key(renamable=True)
+    tail = rename_target(key)
 
-    context[tail] = context[key]
-    del context[key]
-    context.forced_fields.add(tail)
+    context.rename(key, tail)
 
     return f"rename {key} as {tail}"
 
 
 def sort(context: QueryContext):
-    try:
-        key = context.random_key(sortable=True)
-        return random.choice([f"sort {key}", f"sort - {key}"])
-    except IndexError:
-        # No sortable keys in context
-        raise Retry()
+    key, props = context.random_item(sortable=True, feature="sort")
+    context.cover(field_feature("sort", props["type"]))
+    return context.rng.choice([f"sort {key}", f"sort - {key}"])
 
 
 def stats(context: QueryContext):
     # TODO for now we assume stats is terminal and don't deal with context enrichment.
-    stats = random.sample(["count", "sum", "avg", "max", "min"], random.randint(1, 3))
+    # Only count works without numeric fields
+    options = ["count", "sum", "avg", "max", "min"] if len(context.candidates(numeric=True)) > 0 else ["count"]
+    stats = context.rng.sample(options, context.rng.randint(1, min(3, len(options))))
     aggs, agg_keys = [], []
     for stat in stats:
-        try:
-            key = context.random_key(numeric=stat != "count")
-            if stat == "count" and random.random() < 0.5:
-                stat_call = "count()"
-            else:
-                stat_call = f"{stat}({key})"
-            aggs.append(f"{stat_call}")
-            if stat_call != "count()":
-                agg_keys.append(key)
-        except IndexError:
-            continue
-
-    if aggs == []:
-        # All stat loops failed
-        raise Retry()
-
-    by = context.random_key(prefer_forced=True)
+        key = context.random_key(numeric=stat != "count")
+        if stat == "count" and context.rng.random() < 0.5:
+            stat_call = "count()"
+        else:
+            stat_call = f"{stat}({key})"
+        aggs.append(f"{stat_call}")
+        if stat_call != "count()":
+            agg_keys.append(key)
+
+    by = context.random_key(prefer_forced=True, feature="stats by")
     context.filter_to([by] + agg_keys)
 
-    if not any(by in agg for agg in aggs) and (by in context.forced_fields or random.random() < 0.5):
+    if not any(by in agg for agg in aggs) and (by in context.forced_fields or context.rng.random() < 0.5):
+        context.cover(field_feature("stats by", context[by]["type"]))
         return f"stats {', '.join(aggs)} by {by}"
     else:
         return f"stats {', '.join(aggs)}"
@@ -166,74 +149,233 @@ def stats(context: QueryContext):
 
 def where(context: QueryContext):
     exprs = []
-    seen_keys = set()
-    for _ in range(random.choice([1, 1, 1, 2, 2, 3])):
-        key, retries = context.random_key(), 0
-        while key in seen_keys:
-            if retries > 10:
-                raise Retry()
-            key = context.random_key()
-            retries += 1
-        seen_keys.add(key)
-
+    # Each key is used at most once
+    count = min(context.rng.choice([1, 1, 1, 2, 2, 3]), len(context))
+    for key in context.random_keys(count, lambda key: WHERE_FEATURES[context[key]["type"]]):
         expr = context.generate_boolean_expression(key)
         # No "NOT" since it's equivalent to flipping the operation and engines tend to do poorly
         # with generating correct queries corresponding to results with negation
         exprs.append(expr)
     # Not including XOR here since engine struggles a lot with phrasing the questions
-    result = reduce(lambda a, b: a + random.choice([" AND ", " OR "]) + b, exprs)
+    result = reduce(lambda a, b: a + context.rng.choice([" AND ", " OR "]) + b, exprs)
     return f"where {result}"
 
 
-def enable_parsing_if_applicable(context: QueryContext, commands: list[Any]):
-    for _, params in context.items():
-        if "parser" in params:
-            commands.append(parse)
-            return
+# Features `where` can cover with a key of each type
+WHERE_FEATURES = {
+    field_type: tuple(where_feature(field_type, op) for op in ops) for field_type, ops in OPERATORS.items()
+}
 
 
-def generate_segment(
-    context: QueryContext, allow_terminals=False, retries=0
-) -> str | None:
-    if retries >= 10:
-        # Assume this query is at a dead end
-        return None
+# Cheap checks of whether a command can be generated from the context, answered from the context's
+# key indexes. Only commands that pass are drawn, so a drawn command always succeeds. Commands not
+# listed here only need the context to be non-empty.
+PRECONDITIONS = {
+    eval_cmd: lambda context: len(context.candidates(time=True)) > 0,
+    parse: lambda context: len(context.candidates(parse=True)) > 0,
+    rename: lambda context: len(context.candidates(renamable=True)) > 0,
+    sort: lambda context: len(context.candidates(sortable=True)) > 0,
+}
+
+
+def generate_segment(context: QueryContext, allow_terminals=False, metrics: GenerationMetrics | None = None) -> str | None:
     # Forcing commands should mutually exclude each other to prevent death by too-much-context
     forcing = [eval_cmd, rename, parse]
-    choices = [eval_cmd, fields, rename, sort, where]
+    choices = [eval_cmd, fields, rename, sort, where, parse]
     if allow_terminals:
         # Terminal conditions should only go at the end of a query. Generally not strictly necessary
         # that the query ends after one of these, but it's not clear why it'd be necessary
         choices += [dedup, head, rare, stats, top]
-    enable_parsing_if_applicable(context, choices)
 
     for cmd in context.seen_segments:
         if cmd in choices:
             choices.remove(cmd)
         if cmd in forcing:
             choices = [c for c in choices if c not in forcing]
-    segment = random.choice(choices)
-    try:
+    feasible = [c for c in choices if c not in PRECONDITIONS or PRECONDITIONS[c](context)]
+    if metrics is not None:
+        for cmd in choices:
+            if cmd not in feasible:
+                metrics.command(COMMAND_NAMES[cmd]).infeasible += 1
+    if not feasible:
+        # Nothing can follow the query so far
+        return None
+    prev = COMMAND_NAMES[context.seen_segments[-1]] if context.seen_segments else "source"
+    segment = context.choose(
+        feasible, lambda cmd: tuple(f"{prev} | {form}" for form in COMMAND_FORMS[COMMAND_NAMES[cmd]])
+    )
+    if metrics is None:
         return segment(context)
-    except Retry:
-        return generate_segment(context, allow_terminals, retries=retries + 1)
+    command_stats = metrics.command(COMMAND_NAMES[segment])
+    command_stats.attempts += 1
+    start = time.perf_counter()
+    result = segment(context)
+    command_stats.seconds += time.perf_counter() - start
+    return result
 
 
-def generate_query(index_name: str, context: QueryContext):
+def generate_query(index_name: str, context: QueryContext, metrics: GenerationMetrics | None = None):
+    start = time.perf_counter()
     query = f"source = {index_name}"
-    segment_count = random.randint(1, 5)
+    segment_count = context.rng.randint(1, 5)
     for segment_idx in range(segment_count):
         if len(context) == 0:
+            if metrics is not None:
+                metrics.emptied += 1
             break
-        segment = generate_segment(context, segment_idx + 1 == segment_count)
+        segment = generate_segment(context, segment_idx + 1 == segment_count, metrics=metrics)
         if segment is None:
+            if metrics is not None:
+                metrics.dead_ends += 1
             break
         query += " | " + segment
-        context.seen_segments.append(QUERY_FN_MAP[segment.split()[0]])
-
+        name = segment.split()[0]
+        if context.coverage is not None:
+            prev = COMMAND_NAMES[context.seen_segments[-1]] if context.seen_segments else "source"
+            form = f"{name} by" if f"{name} by" in COMMAND_FORMS[name] and " by " in segment else name
+            context.cover(f"{prev} | {form}")
+        context.seen_segments.append(QUERY_FN_MAP[name])
+
+    if context.coverage is not None:
+        context.coverage.end_query()
+    if metrics is not None:
+        metrics.queries += 1
+        metrics.segments += len(context.seen_segments)
+        metrics.seconds += time.perf_counter() - start
     return query
 
 
+# Queries are generated in fixed-size chunks, each with its own RNG seeded from the master seed
+# and the chunk index. The output for a given seed is then the same no matter how many processes
+# the chunks are spread over.
+CHUNK_SIZE = 256
+
+# Set in each pool worker by `_init_worker`, so the schema is only sent to a process once
+_worker_schema = None
+
+
+def _init_worker(schema: Schema | dict):
+    global _worker_schema
+    _worker_schema = schema if isinstance(schema, Schema) else Schema(schema)
+
+
+def chunk_rng(seed: int, chunk_idx: int) -> random.Random:
+    # String seeds are hashed with SHA-512, so this is stable across processes and interpreter runs
+    return random.Random(f"{seed}:{chunk_idx}")
+
+
+def generate_chunk(
+    index_name: str,
+    schema: Schema,
+    seed: int,
+    chunk_idx: int,
+    size: int,
+    metrics: GenerationMetrics | None = None,
+    coverage: CoverageTracker | None = None,
+):
+    rng = chunk_rng(seed, chunk_idx)
+    literals = LiteralSampler(seeded_generator(f"{seed}:{chunk_idx}"))
+    for _ in range(size):
+        yield generate_query(index_name, QueryContext(schema, rng, literals, coverage), metrics)
+
+
+def _generate_worker_chunk(args) -> tuple[list[str], GenerationMetrics | None, CoverageTracker | None]:
+    index_name, seed, chunk_idx, size, collect_metrics, collect_coverage = args
+    metrics = GenerationMetrics(index_name) if collect_metrics else None
+    # Only counts are needed from workers: coverage of the universe is worked out after merging
+    coverage = CoverageTracker() if collect_coverage else None
+    queries = list(generate_chunk(index_name, _worker_schema, seed, chunk_idx, size, metrics, coverage))
+    return queries, metrics, coverage
+
+
+def generate_queries(
+    index_name: str,
+    schema: Schema | dict,
+    count: int,
+    seed: int,
+    processes: int = 1,
+    metrics: GenerationMetrics | None = None,
+    coverage: CoverageTracker | None = None,
+    coverage_target: float | None = None,
+):
+    """
+    Lazily generate `count` queries against `schema`. Queries are only built as the consumer asks
+    for them, so downstream stages (verification, output) bound how far ahead generation runs.
+    With `processes > 1` chunks are generated on a process pool, a few chunks ahead per process.
+    The same seed always gives the same queries in the same order. Generation counters and timers
+    are added to `metrics` if given.
+
+    Grammar features covered are counted in `coverage` if given, and generation stops early once
+    `coverage_target` of its universe is covered. An adaptive tracker steers every choice by what
+    earlier queries covered, so adaptive generation runs in this process regardless of `processes`.
+    """
+    queries = _generate_queries(index_name, schema, count, seed, processes, metrics, coverage)
+    if coverage_target is None:
+        yield from queries
+        return
+    for generated, query in enumerate(queries, 1):
+        yield query
+        if coverage.reached(coverage_target, generated):
+            queries.close()
+            return
+
+
+def _generate_queries(index_name, schema, count, seed, processes, metrics, coverage):
+    chunks = [
+        (index_name, seed, chunk_idx, min(CHUNK_SIZE, count - start), metrics is not None, coverage is not None)
+        for chunk_idx, start in enumerate(range(0, count, CHUNK_SIZE))
+    ]
+    if processes <= 1 or (coverage is not None and coverage.adaptive):
+        if not isinstance(schema, Schema):
+            schema = Schema(schema)
+        for index_name, seed, chunk_idx, size, _, _ in chunks:
+            yield from generate_chunk(index_name, schema, seed, chunk_idx, size, metrics, coverage)
+        return
+
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(schema,)) as executor:
+        for _, (queries, chunk_metrics, chunk_coverage) in bounded_map(
+            executor, _generate_worker_chunk, chunks, 2 * processes
+        ):
+            if metrics is not None:
+                metrics.merge(chunk_metrics)
+            if coverage is not None:
+                coverage.merge(chunk_coverage)
+            yield from queries
+
+
+def grammar_features(schema: Schema) -> set[str]:
+    """
+    Grammar features generation can cover for `schema`, as named by `QueryContext.cover`: each
+    command following each other command or the source, `where` with each operator on each type of
+    field, and the types of field commands like `sort` and `stats ... by` act on. Commands whose
+    preconditions the schema can never meet are left out. The rest are reachable in principle, but
+    a few combinations may be rare in practice (e.g. `fields | parse` needs `fields` to keep the
+    parsed field).
+    """
+    context = QueryContext(schema)
+    types = {props["type"] for props in schema.fields.values()}
+    names = [name for name, cmd in QUERY_FN_MAP.items() if cmd not in PRECONDITIONS or PRECONDITIONS[cmd](context)]
+    if "eval" in names:
+        types.add("int")
+
+    features = set()
+    for field_type in types:
+        features.update(WHERE_FEATURES[field_type])
+        for command in ("dedup", "rare", "top", "stats by"):
+            features.add(field_feature(command, field_type))
+        if "sort" in names and INDEX_PREDICATES["sortable"](None, {"type": field_type}):
+            features.add(field_feature("sort", field_type))
+    # Mirrors the rules in `generate_segment`: terminals only end a query, no command repeats, and
+    # no two forcing commands in one query
+    forcing = {"eval", "parse", "rename"}
+    for prev in ["source"] + [name for name in names if name not in TERMINALS]:
+        for name in names:
+            if name == prev or (prev in forcing and name in forcing):
+                continue
+            features.update(f"{prev} | {form}" for form in COMMAND_FORMS[name])
+    return features
+
+
 QUERY_FN_MAP = {
     "dedup": dedup,
     "eval": eval_cmd,
@@ -247,28 +389,216 @@ QUERY_FN_MAP = {
     "stats": stats,
     "where": where,
 }
+COMMAND_NAMES = {fn: name for name, fn in QUERY_FN_MAP.items()}
+TERMINALS = {"dedup", "head", "rare", "stats", "top"}
+# Forms of each command told apart by coverage
+COMMAND_FORMS = {name: [name, f"{name} by"] if name in ("rare", "stats", "top") else [name] for name in QUERY_FN_MAP}
 
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2 or len(sys.argv) > 3:
-        print("Usage: gen_queries.py [schema] [quantity?]")
-        exit(1)
-    schema_name = sys.argv[1]
-
-    if len(sys.argv) == 3:
-        gen_count = int(sys.argv[2])
+def add_run_arguments(parser: argparse.ArgumentParser):
+    """
+    Command-line options for what happens to generated queries (filtering, verification and
+    metrics), shared by gen_queries.py and batch.py.
+    """
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=8,
+        help="maximum number of verification requests outstanding at once (default 8)",
+    )
+    parser.add_argument(
+        "--balance",
+        choices=("round-robin", "least-outstanding"),
+        default=None,
+        help="how verification requests are spread over the nodes in client_conf.json "
+        "(default: the config's `balance`, or round-robin)",
+    )
+    parser.add_argument(
+        "--cache",
+        default=None,
+        help="SQLite file caching verification results across runs (default: no cache)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1_000_000,
+        help="maximum number of cached results, least recently used are evicted (default 1000000)",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=VERIFY_MODES,
+        default="run",
+        help="run: execute queries fully; discard: execute with a capped, discarded result; "
+        "explain: only plan queries (default run)",
+    )
+    parser.add_argument(
+        "--generate-only",
+        action="store_true",
+        help="print the generated queries without verifying them (the client library isn't loaded)",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="drop queries already generated in this run before they're sent to the cluster",
+    )
+    parser.add_argument(
+        "--dedup-capacity",
+        type=int,
+        default=10_000_000,
+        help="unique queries the duplicate filter is sized for (default 10000000)",
+    )
+    parser.add_argument(
+        "--dedup-error-rate",
+        type=float,
+        default=0.001,
+        help="fraction of unique queries the duplicate filter may drop by mistake (default 0.001)",
+    )
+    parser.add_argument(
+        "--prevalidate",
+        action="store_true",
+        help="check queries against the schema offline, and only send the valid ones to the cluster",
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="report per-command generation attempts, retries, dead ends and time on stderr",
+    )
+    parser.add_argument(
+        "--metrics-out",
+        default=None,
+        help="write generation metrics as JSON to this file (implies collecting them)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=None,
+        help="write every query as an NDJSON record (schema, seed, commands, status, error, latency) "
+        "to shard files in this directory, instead of printing the valid ones",
+    )
+    parser.add_argument(
+        "--output-prefix", default="queries", help="file name prefix of output shards (default queries)"
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=256,
+        help="MB of records (before compression) per output shard (default 256)",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=COMPRESSIONS,
+        default="none",
+        help="compress output shards; zstd needs the zstandard package (default none)",
+    )
+
+
+def verify_or_print(queries, args: argparse.Namespace, seed: int):
+    """
+    Last stage of a command-line run: verify `queries` against the cluster as `args` say, printing
+    the valid ones, or with `--generate-only` just print them. With `--output-dir`, every query is
+    written to output shards instead, with its result if it was verified.
+    """
+    sink = None
+    if args.output_dir is not None:
+        try:
+            sink = ShardedWriter(args.output_dir, args.output_prefix, args.shard_size * 1024 * 1024, args.compress)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    if args.generate_only:
+        for ppl_query in queries:
+            if sink is not None:
+                sink.write(query_record(ppl_query, seed))
+            else:
+                print(ppl_query)
     else:
-        gen_count = 10
-
-    with open(f"schemas/{schema_name}.json", "r") as schema_file:
-        schema = json.load(schema_file)
-
-    queries = []
-    for _ in range(gen_count):
-        context = QueryContext(schema)
-        query = generate_query(schema_name, context)
-        queries.append(query)
-    
-    client = make_client()
-    for query in queries:
-        verify(client, query)
+        client = make_client(pool_maxsize=args.max_in_flight, balance=args.balance)
+        cache = None
+        if args.cache is not None:
+            # A query that plans fine may still fail when run, so modes don't share results
+            cache = ResultCache(args.cache, f"{cluster_identity(client)}#{args.mode}", args.cache_size)
+        write = None
+        if sink is not None:
+            write = lambda ppl_query, result: sink.write(query_record(ppl_query, seed, result))
+        verify_all(client, queries, max_in_flight=args.max_in_flight, cache=cache, mode=args.mode, write=write)
+        if cache is not None:
+            cache.close()
+    if sink is not None:
+        sink.close()
+        print(sink.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate and verify random PPL queries.")
+    parser.add_argument("schema", help="schema name, read from schemas/[schema].json")
+    parser.add_argument("quantity", type=int, nargs="?", default=10)
+    add_run_arguments(parser)
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="master seed for generation; the same seed always gives the same queries",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="number of processes to generate queries with (default 1)",
+    )
+    parser.add_argument(
+        "--coverage",
+        action="store_true",
+        help="report which command, field type and operator combinations the queries covered, and when",
+    )
+    parser.add_argument(
+        "--coverage-guided",
+        action="store_true",
+        help="bias generation toward combinations not covered yet (implies --coverage; generates in one process)",
+    )
+    parser.add_argument(
+        "--coverage-target",
+        type=float,
+        default=None,
+        help="stop generating once this fraction of combinations is covered (0-1, implies --coverage)",
+    )
+    parser.add_argument(
+        "--coverage-out",
+        default=None,
+        help="write coverage, including coverage over time, as JSON to this file (implies --coverage)",
+    )
+    args = parser.parse_args()
+    if args.max_in_flight < 1:
+        parser.error("--max-in-flight must be at least 1")
+    schema_name = args.schema
+    seed = args.seed if args.seed is not None else random.randrange(2**32)
+    print(f"Using seed {seed}", file=sys.stderr)
+
+    schema = load_schema(schema_name)
+
+    metrics = GenerationMetrics(schema_name) if args.metrics or args.metrics_out else None
+    coverage = None
+    if args.coverage or args.coverage_guided or args.coverage_target is not None or args.coverage_out:
+        coverage = CoverageTracker(grammar_features(schema), adaptive=args.coverage_guided)
+        if args.coverage_guided and args.processes > 1:
+            print("Coverage-guided generation runs in one process", file=sys.stderr)
+    queries = generate_queries(
+        schema_name, schema, args.quantity, seed, args.processes, metrics, coverage, args.coverage_target
+    )
+    duplicates = None
+    if args.dedup:
+        duplicates = DuplicateFilter(args.dedup_capacity, args.dedup_error_rate)
+        queries = duplicates.filter(queries)
+    if args.prevalidate:
+        queries = validate_all(queries, schema, schema_name)
+    verify_or_print(queries, args, seed)
+    if duplicates is not None:
+        print(duplicates.summary(), file=sys.stderr)
+    if args.metrics:
+        print(metrics.summary(), file=sys.stderr)
+    if coverage is not None:
+        print(coverage.summary(), file=sys.stderr)
+    if args.coverage_out is not None:
+        with open(args.coverage_out, "w") as coverage_file:
+            json.dump({"seed": seed, "schemas": {schema_name: coverage.to_dict()}}, coverage_file, indent=2)
+    if args.metrics_out is not None:
+        with open(args.metrics_out, "w") as metrics_file:
+            json.dump({"seed": seed, "schemas": {schema_name: metrics.to_dict()}}, metrics_file, indent=2)
@@ -0,0 +1,141 @@
+"""
+Grammar coverage of generated queries: which combinations of command, field type and operator
+(e.g. `where text LIKE`, `sort time`, `eval | stats by`) a run has produced, out of those the schema
+makes reachable. A tracker can also steer generation toward combinations it hasn't seen yet, so a
+run reaches a given coverage with fewer queries sent to the cluster.
+"""
+
+
+class CoverageTracker:
+    """
+    Counts of the grammar features covered by generated queries, out of a `universe` of features to
+    aim for. Features are plain strings, named by the generator (see `grammar_features` in
+    gen_queries.py). Features outside the universe are still counted, but not toward coverage.
+
+    With `adaptive`, contexts consult the tracker at each random choice that decides a feature, and
+    favour options leading to features covered least so far: an option's weight is `1 / (1 + n)`
+    for the least covered feature it can lead to, covered `n` times.
+    """
+
+    def __init__(self, universe=(), adaptive: bool = False):
+        self.universe = frozenset(universe)
+        self.adaptive = adaptive
+        self.queries = 0
+        self.counts = {}
+        # Number of queries generated when each feature was first covered, including the covering one
+        self.first_seen = {}
+
+    def cover(self, feature: str):
+        count = self.counts.get(feature, 0)
+        if count == 0:
+            self.first_seen[feature] = self.queries + 1
+        self.counts[feature] = count + 1
+
+    def end_query(self):
+        self.queries += 1
+
+    def weight(self, features) -> float:
+        return max(1.0 / (1 + self.counts.get(feature, 0)) for feature in features)
+
+    def choose(self, rng, options, features):
+        """
+        Weighted random choice from `options`, where `features(option)` gives the tuple of features
+        an option can lead to. Options leading to the same features share their weight, so a
+        feature isn't favoured just because many options lead to it (e.g. many keyword fields).
+        """
+        groups = {}
+        for option in options:
+            groups.setdefault(features(option), []).append(option)
+        group_features = list(groups)
+        chosen = rng.choices(group_features, [self.weight(f) for f in group_features])[0]
+        return rng.choice(groups[chosen])
+
+    def sample(self, rng, options, k: int, features) -> list:
+        # `choose` without replacement
+        options = list(options)
+        picks = []
+        for _ in range(k):
+            pick = self.choose(rng, options, features)
+            options.remove(pick)
+            picks.append(pick)
+        return picks
+
+    def merge(self, other):
+        """
+        Add the counts of a tracker for the queries generated after this one's, e.g. the next chunk.
+        """
+        for feature, first in other.first_seen.items():
+            if feature not in self.first_seen:
+                self.first_seen[feature] = self.queries + first
+        for feature, count in other.counts.items():
+            self.counts[feature] = self.counts.get(feature, 0) + count
+        self.queries += other.queries
+
+    @property
+    def covered(self) -> int:
+        return sum(1 for feature in self.universe if feature in self.counts)
+
+    @property
+    def fraction(self) -> float:
+        return self.covered / len(self.universe) if self.universe else 1.0
+
+    def timeline(self) -> list[tuple[int, int]]:
+        """
+        Coverage over time, as `(queries, covered)` points at each query that covered new features.
+        """
+        points = []
+        covered = 0
+        for first in sorted(self.first_seen[f] for f in self.universe if f in self.first_seen):
+            covered += 1
+            if points and points[-1][0] == first:
+                points[-1] = (first, covered)
+            else:
+                points.append((first, covered))
+        return points
+
+    def queries_to_reach(self, fraction: float) -> int | None:
+        """
+        Number of queries it took to cover `fraction` of the universe, or None if it hasn't been yet.
+        """
+        needed = fraction * len(self.universe)
+        if needed <= 0:
+            return 0
+        for queries, covered in self.timeline():
+            if covered >= needed:
+                return queries
+        return None
+
+    def reached(self, fraction: float, queries: int) -> bool:
+        needed = self.queries_to_reach(fraction)
+        return needed is not None and needed <= queries
+
+    def to_dict(self):
+        return {
+            "queries": self.queries,
+            "adaptive": self.adaptive,
+            "features": len(self.universe),
+            "covered": self.covered,
+            "fraction": self.fraction,
+            "timeline": self.timeline(),
+            "uncovered": sorted(self.universe - self.counts.keys()),
+            "counts": {feature: self.counts[feature] for feature in sorted(self.counts)},
+        }
+
+    def summary(self) -> str:
+        mode = "coverage-guided" if self.adaptive else "uniform"
+        lines = [
+            f"Coverage: {self.covered} of {len(self.universe)} grammar features ({self.fraction:.1%}) "
+            f"after {self.queries} {mode} queries"
+        ]
+        milestones = []
+        for fraction in (0.5, 0.75, 0.9, 0.95, 0.99, 1.0):
+            queries = self.queries_to_reach(fraction)
+            if queries is None:
+                break
+            milestones.append(f"{fraction:.0%} after {queries}")
+        if milestones:
+            lines.append(f"  {', '.join(milestones)}")
+        uncovered = sorted(self.universe - self.counts.keys())
+        if uncovered:
+            lines.append(f"  uncovered: {', '.join(uncovered)}")
+        return "\n".join(lines)
@@ -0,0 +1,88 @@
+"""
+Batch sampling of literals for generated expressions. Rather than calling into `random` for every
+literal, uniform variates are drawn in blocks with a NumPy Generator, and each literal is then a
+lookup or a little arithmetic on the next variate. Formatting that only depends on the value
+drawn, like rendering timestamps, is memoized across queries.
+
+One block of variates serves every field, because a chunk of queries only draws a handful of
+literals per field: per-field blocks would mostly be thrown away with the chunk.
+"""
+
+import functools
+import hashlib
+import math
+import time
+import numpy as np
+
+MIN_BLOCK = 64
+MAX_BLOCK = 4096
+
+
+def seeded_generator(seed) -> np.random.Generator:
+    # Same idea as `chunk_rng`: a string seed hashed to something stable across processes
+    return np.random.default_rng(int.from_bytes(hashlib.sha256(str(seed).encode()).digest(), "big"))
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def timestamp_literal(second: int) -> str:
+    return f"TIMESTAMP('{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(second))}')"
+
+
+class LiteralSampler:
+    """
+    Draws literals formatted the same way as `QueryContext.sample_value`, from blocks of uniform
+    variates in [0, 1). Blocks start small and double each time one runs out, so a short run only
+    draws what it needs.
+    """
+
+    def __init__(self, generator: np.random.Generator):
+        self.generator = generator
+        self._uniforms = []
+        self._block = MIN_BLOCK
+
+    def _refill(self) -> float:
+        self._uniforms = self.generator.random(self._block).tolist()
+        self._block = min(self._block * 2, MAX_BLOCK)
+        return self._uniforms.pop()
+
+    def uniform(self) -> float:
+        return self._uniforms.pop() if self._uniforms else self._refill()
+
+    def sample(self, props: dict) -> str:
+        # Inlined `uniform`, since this is called for every literal. Every type takes exactly one
+        # variate, and `int(u * n)` is below n for any u < 1 and n < 2**52.
+        u = self._uniforms.pop() if self._uniforms else self._refill()
+        match props["type"]:
+            case "keyword" | "text":
+                pool = props["value_reprs"]
+                return pool[int(u * len(pool))]
+            case "list":
+                pool = props["item_reprs"]
+                return pool[int(u * len(pool))]
+            case "int":
+                low = int(props["min"])
+                return str(low + int(u * (int(props["max"]) - low + 1)))
+            case "float":
+                return repr(round(u * (props["max"] - props["min"]) + props["min"], 1))
+            case "time":
+                span = props["max_epoch"] - props["min_epoch"]
+                return timestamp_literal(math.floor(props["min_epoch"] + u * span))
+            case "bool":
+                return "true" if u > 0.5 else "false"
+            case unknown:
+                raise ValueError(f"Unknown prop type: {unknown}")
+
+    def sample_in_tuple(self, props: dict) -> str:
+        """
+        `repr` of a tuple of 2 to 4 distinct values of a keyword field with at least 2 values.
+        """
+        values = props["values"]
+        count = 2 + int(self.uniform() * (min(len(values), 4) - 1))
+        # Partial Fisher-Yates shuffle over the indexes, only materializing the swapped ones
+        swapped = {}
+        picks = []
+        for i in range(count):
+            j = i + int(self.uniform() * (len(values) - i))
+            picks.append(values[swapped.get(j, j)])
+            swapped[j] = swapped.get(i, i)
+        return repr(tuple(picks))
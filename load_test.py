@@ -0,0 +1,281 @@
+"""
+Load test a cluster by replaying generated queries against it for a set duration, either
+open-loop at a fixed rate or closed-loop with a fixed number of workers. Queries are generated up
+front from a schema (or read from a file of pre-generated queries, one per line) and replayed in
+order, cycling as needed.
+
+- open-loop (`--qps`): requests are sent on a fixed schedule whether or not earlier ones have
+  finished, and latency is measured from when a request was due, not when it was sent. A cluster
+  falling behind therefore shows up as growing latency, instead of the load quietly easing off.
+- closed-loop (`--workers`): each worker sends its next query as soon as the last one finishes, so
+  throughput is whatever the cluster sustains at that concurrency.
+
+Latency is recorded in HDR-style histograms, overall and per command mix (the query's commands in
+order, e.g. `where | stats`), and results are written as JSON along with per-node stats.
+
+Usage: load_test.py [schema] (--qps 50 | --workers 8) [--duration 60] [--queries file] [--output results.json]
+"""
+
+import argparse
+import itertools
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from compile_schema import load_schema
+from gen_queries import generate_queries
+from nodes import node_connections
+from revision import git_revision
+from sketches import LatencyHistogram
+from validate_query import InvalidQuery, split_segments
+from verify_query import VERIFY_MODES, make_client, run_ppl_query
+
+
+def command_mix(ppl_query: str) -> str:
+    try:
+        return " | ".join(command for command, _ in split_segments(ppl_query))
+    except InvalidQuery:
+        return "unparsed"
+
+
+class MixResults:
+    """
+    Outcomes and latencies of the requests for one command mix. Failures are requests that got no
+    response at all (e.g. the connection failed), so they have no latency.
+    """
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.ok = 0
+        self.errors = 0
+        self.failures = 0
+
+    def record(self, seconds: float, result: dict):
+        if result["success"]:
+            self.ok += 1
+        elif isinstance(result.get("status_code"), int):
+            self.errors += 1
+        else:
+            self.failures += 1
+            return
+        self.latency.record(seconds)
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        self.ok += other.ok
+        self.errors += other.errors
+        self.failures += other.failures
+
+    def to_dict(self, elapsed: float):
+        requests = self.ok + self.errors + self.failures
+        return {
+            "requests": requests,
+            "ok": self.ok,
+            "errors": self.errors,
+            "failures": self.failures,
+            "throughput_qps": requests / elapsed if elapsed > 0 else 0.0,
+            "latency": self.latency.summary(),
+        }
+
+
+class LoadResults:
+    """
+    `MixResults` per command mix, recorded from every sending thread.
+    """
+
+    def __init__(self):
+        self.mixes = {}
+        self._lock = threading.Lock()
+
+    def record(self, mix: str, seconds: float, result: dict):
+        with self._lock:
+            if mix not in self.mixes:
+                self.mixes[mix] = MixResults()
+            self.mixes[mix].record(seconds, result)
+
+    def total(self) -> MixResults:
+        total = MixResults()
+        for mix_results in self.mixes.values():
+            total.merge(mix_results)
+        return total
+
+
+class QueryCycle:
+    """
+    Queries (with their command mixes) handed out in order to any number of threads, starting over
+    at the end.
+    """
+
+    def __init__(self, ppl_queries: list[str]):
+        self._queries = itertools.cycle([(q, command_mix(q)) for q in ppl_queries])
+        self._lock = threading.Lock()
+
+    def next(self) -> tuple[str, str]:
+        with self._lock:
+            return next(self._queries)
+
+
+def send(client, query: tuple[str, str], mode: str, due: float, results: LoadResults):
+    ppl_query, mix = query
+    try:
+        result = run_ppl_query(client, ppl_query, mode)
+    except Exception as e:
+        # Anything but a transport error, which would otherwise be lost on the sending thread (and
+        # stop a closed-loop worker). It's counted as a request that got no response.
+        print(f"Unexpected error sending query:\n> Query: {ppl_query}\n> Error: {e!r}", file=sys.stderr)
+        result = {"response": None, "success": 0, "status_code": None, "error": type(e).__name__}
+    results.record(mix, time.perf_counter() - due, result)
+
+
+def run_open_loop(client, queries: QueryCycle, qps: float, duration: float, max_in_flight: int, mode: str):
+    """
+    Send `qps` requests per second for `duration` seconds, with at most `max_in_flight` requests
+    outstanding. Requests due while all are outstanding wait their turn, and the wait counts toward
+    their latency. Returns the results and the seconds until the last response.
+    """
+    results = LoadResults()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for i in itertools.count():
+            due = start + i / qps
+            if due - start >= duration:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, client, queries.next(), mode, due, results)
+    return results, time.perf_counter() - start
+
+
+def run_closed_loop(client, queries: QueryCycle, workers: int, duration: float, mode: str):
+    """
+    Keep `workers` requests outstanding for `duration` seconds. Returns the results and the seconds
+    until the last response.
+    """
+    results = LoadResults()
+    start = time.perf_counter()
+    deadline = start + duration
+
+    def worker():
+        while time.perf_counter() < deadline:
+            send(client, queries.next(), mode, time.perf_counter(), results)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def report(results: LoadResults, elapsed: float) -> dict:
+    total = results.total()
+    return {
+        **total.to_dict(elapsed),
+        "elapsed_s": elapsed,
+        "mixes": {mix: results.mixes[mix].to_dict(elapsed) for mix in sorted(results.mixes)},
+    }
+
+
+def summary(load: dict, top: int = 10) -> str:
+    latency = load["latency"]
+    lines = [
+        f"Sent {load['requests']} requests in {load['elapsed_s']:.1f}s ({load['throughput_qps']:.1f} queries/s), "
+        f"{load['errors']} errors, {load['failures']} failures; latency p50 {latency['p50_ms']:.1f}ms, "
+        f"p95 {latency['p95_ms']:.1f}ms, p99 {latency['p99_ms']:.1f}ms, max {latency['max_ms']:.1f}ms",
+        f"  {'command mix':<40} {'requests':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}",
+    ]
+    # Busiest mixes first
+    mixes = sorted(load["mixes"].items(), key=lambda item: -item[1]["requests"])
+    for mix, mix_load in mixes[:top]:
+        latency = mix_load["latency"]
+        lines.append(
+            f"  {mix:<40} {mix_load['requests']:>8} {latency['p50_ms']:>8.1f} {latency['p95_ms']:>8.1f} "
+            f"{latency['p99_ms']:>8.1f} {latency['max_ms']:>8.1f}"
+        )
+    if len(mixes) > top:
+        lines.append(f"  ... and {len(mixes) - top} more mixes")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test a cluster with generated PPL queries.")
+    parser.add_argument(
+        "schema", nargs="?", default=None, help="schema name, read from schemas/[schema].json (unless --queries)"
+    )
+    loop = parser.add_mutually_exclusive_group(required=True)
+    loop.add_argument("--qps", type=float, help="open-loop: send this many queries per second")
+    loop.add_argument("--workers", type=int, help="closed-loop: keep this many queries outstanding")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to send queries for (default 60)")
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=64,
+        help="open-loop: most queries outstanding at once; later ones wait (default 64)",
+    )
+    parser.add_argument(
+        "--queries",
+        default=None,
+        help="file of pre-generated queries, one per line, to replay instead of generating them",
+    )
+    parser.add_argument("--pool", type=int, default=10_000, help="queries to generate and cycle through (default 10000)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for generating queries (default 0)")
+    parser.add_argument("--mode", choices=VERIFY_MODES, default="run", help="how much work each query does (default run)")
+    parser.add_argument(
+        "--balance", choices=("round-robin", "least-outstanding"), default=None, help="how queries are spread over nodes"
+    )
+    parser.add_argument("--output", default=None, help="file to write JSON results to (default: stdout)")
+    args = parser.parse_args()
+    if args.schema is None and args.queries is None:
+        parser.error("give a schema to generate queries from, or --queries")
+    if args.qps is not None and args.qps <= 0:
+        parser.error("--qps must be greater than 0")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.max_in_flight < 1:
+        parser.error("--max-in-flight must be at least 1")
+
+    if args.queries is not None:
+        with open(args.queries, "r") as queries_file:
+            ppl_queries = [line.strip() for line in queries_file if line.strip()]
+    else:
+        ppl_queries = list(generate_queries(args.schema, load_schema(args.schema), args.pool, args.seed))
+    queries = QueryCycle(ppl_queries)
+
+    concurrency = args.workers if args.workers is not None else args.max_in_flight
+    client = make_client(pool_maxsize=concurrency, balance=args.balance)
+    if args.qps is not None:
+        print(f"Sending {args.qps} queries/s for {args.duration}s", file=sys.stderr)
+        results, elapsed = run_open_loop(client, queries, args.qps, args.duration, args.max_in_flight, args.mode)
+    else:
+        print(f"Sending queries from {args.workers} workers for {args.duration}s", file=sys.stderr)
+        results, elapsed = run_closed_loop(client, queries, args.workers, args.duration, args.mode)
+
+    load = report(results, elapsed)
+    print(summary(load), file=sys.stderr)
+    output = {
+        "revision": git_revision(),
+        "schema": args.schema,
+        "queries": args.queries,
+        "pool": len(ppl_queries),
+        "seed": args.seed if args.queries is None else None,
+        "mode": args.mode,
+        "loop": "open" if args.qps is not None else "closed",
+        "target_qps": args.qps,
+        "workers": args.workers,
+        "max_in_flight": args.max_in_flight if args.qps is not None else None,
+        "duration_s": args.duration,
+        **load,
+        "nodes": {
+            connection.host: connection.stats.to_dict()
+            for connection in node_connections(client)
+            if hasattr(connection, "stats")
+        },
+    }
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(output, output_file, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
@@ -1,20 +1,56 @@
 """
 Given a sample data file as json input, generate a corresponding schema file.
-For now these are hardcoded params at the end, make it into CLI args if you wish.
+Records are streamed from the file and profiled one at a time, so arbitrarily large exports can
+be profiled in bounded memory. Large or multiple inputs are split into shards that are profiled in
+parallel, and the partial profiles merged into the final schema.
 """
 
-from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import functools
 import json
+import os
 import re
 import datetime
-import sys
+from pipeline import bounded_map
+from sketches import HyperLogLog, MisraGries
 
-def can_iso_parse(date_string):
+# Cheap lexical check that a string looks like an ISO 8601 date or datetime, so that only plausible
+# strings are handed to `fromisoformat` and the common case raises no exceptions
+ISO_TIME_RE = re.compile(
+    r"\d{4}-\d{2}-\d{2}(?:[T ]\d{2}(?::?\d{2}(?::?\d{2}(?:[.,]\d+)?)?)?)?(?:Z|[+-]\d{2}(?::?\d{2})?)?"
+)
+
+
+def parse_time(string):
+    """
+    Epoch seconds of an ISO 8601 time string, or None if it isn't one. Times without a timezone
+    are taken to be UTC.
+    """
+    if not ISO_TIME_RE.fullmatch(string):
+        return None
     try:
-        datetime.datetime.fromisoformat(date_string)
-        return True
-    except:
-        return False
+        parsed = datetime.datetime.fromisoformat(string)
+    except ValueError:
+        # Looked like a time but isn't one, e.g. month 13
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+# Bumped whenever the format written by `SchemaProfile.to_partial` changes
+PARTIAL_SCHEMA_VERSION = 4
+# Input files with this suffix are partial profiles written with `--partial`, not records
+PARTIAL_SUFFIX = ".partial.json"
+# NDJSON inputs are split into byte ranges of about this size to be profiled in parallel
+SHARD_SIZE = 64 << 20
+
+# Value counts are exact for up to this many distinct values per field, after which they're
+# summarized by a Misra-Gries sketch of the same size, so memory stays bounded.
+MAX_TRACKED_VALUES = 10_000
+# Distinct counts past MAX_TRACKED_VALUES are estimated by a HyperLogLog of this precision
+HLL_PRECISION = 12
 
 
 def scan_record(record, target, prefix=""):
@@ -23,122 +59,470 @@ def scan_record(record, target, prefix=""):
             scan_record(value, target, prefix + f"{key}.")
             continue
 
-        target[prefix + key].append(value)
+        target.add_value(prefix + key, value)
 
 
-def columnar_aggregate_records(records):
-    result = defaultdict(lambda: [])
-    # We don't especially care about null handling here, since we want to only sample
-    # non-nulls in schema generation
-    for record in records:
-        scan_record(record, result)
-    return result
+def iter_records(path, block_size=1 << 16):
+    """
+    Incrementally read records from a JSON array or NDJSON file, without loading the whole file.
+    Records exported directly from an OS index are unwrapped to their `_source`.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r") as in_file:
+        buf, idx, eof = "", 0, False
+        while True:
+            # Skip separators between records: whitespace, and the brackets and commas of an array
+            while idx < len(buf) and buf[idx] in " \t\r\n,[]":
+                idx += 1
+            if idx == len(buf):
+                if eof:
+                    return
+                buf, idx = in_file.read(block_size), 0
+                eof = buf == ""
+                continue
+            try:
+                record, end = decoder.raw_decode(buf, idx)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # The record is cut off by the end of the buffer. Read more, reading bigger blocks
+                # each time so records larger than the block size don't take quadratic time.
+                more = in_file.read(max(block_size, len(buf) - idx))
+                buf, idx, eof = buf[idx:] + more, 0, more == ""
+                continue
+            idx = end
+            yield unwrap_record(record)
+
 
+def unwrap_record(record):
+    # Detect and transform data exported directly from an OS index
+    if "_source" in record and "_index" in record:
+        return record["_source"]
+    return record
 
-def find_type(value):
-    if isinstance(value, str) and can_iso_parse(value):
-        return "time"
-    elif isinstance(value, str):
-        return "str"
+
+def is_ndjson(path):
+    # Decided from the first non-whitespace byte, read a block at a time, since a minified JSON
+    # array is one long line
+    with open(path, "rb") as in_file:
+        while block := in_file.read(4096):
+            block = block.lstrip()
+            if block:
+                return not block.startswith(b"[")
+    return True
+
+
+def iter_record_range(path, start, end):
+    """
+    Read the NDJSON records whose lines start within bytes [start, end) of the file.
+    """
+    with open(path, "rb") as in_file:
+        if start > 0:
+            # Skip the line that started before this range, it belongs to the previous shard
+            in_file.seek(start - 1)
+            in_file.readline()
+        pos = in_file.tell()
+        while pos < end:
+            line = in_file.readline()
+            if not line:
+                return
+            pos += len(line)
+            if line.strip():
+                yield unwrap_record(json.loads(line))
+
+
+def classify(value):
+    """
+    Type of a single non-null value, and what the type's bounds are computed over: the value for
+    numbers, `(epoch, raw string)` for times, the length for lists and nothing for strings.
+    """
+    if isinstance(value, str):
+        epoch = parse_time(value)
+        if epoch is not None:
+            return "time", (epoch, value)
+        return "str", None
     elif isinstance(value, bool):
-        return "bool"
+        return "bool", value
     elif isinstance(value, int):
-        return "int"
+        return "int", value
     elif isinstance(value, float):
-        return "float"
+        return "float", value
     elif isinstance(value, list):
-        return "list"
+        return "list", len(value)
     else:
         raise ValueError(f"unable to find type of {repr(value)}")
 
 
-def find_schema(agg_records):
-    # Assume at least one column is always populated, to test nullability
-    record_count = max(len(v) for v in agg_records.values())
-    result = {}
-    for key, values in agg_records.items():
-        values = [v for v in values if v is not None]
-        first_value = next(iter(values), None)
-        value_type = find_type(first_value) if first_value else "none"
-        nullable = len(values) < record_count
-        match value_type:
+class TypeStats:
+    """
+    Count and bounds of the values of a single type seen in a field.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.min = self.max = None
+
+    def add(self, bound):
+        self.count += 1
+        if bound is None:
+            return
+        if self.count == 1:
+            self.min = self.max = bound
+        elif bound < self.min:
+            self.min = bound
+        elif bound > self.max:
+            self.max = bound
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.min, self.max = other.min, other.max
+        elif self.min is not None:
+            self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self.count += other.count
+
+    def to_partial(self):
+        return {"count": self.count, "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_partial(cls, partial):
+        result = cls()
+        result.count = partial["count"]
+        # Time bounds are tuples, which JSON turns into lists
+        as_bound = lambda b: tuple(b) if isinstance(b, list) else b
+        result.min, result.max = as_bound(partial["min"]), as_bound(partial["max"])
+        return result
+
+
+class FieldProfile:
+    """
+    Running statistics for one field, updated a value at a time. Every value's type is checked,
+    and the field's type is decided from all of them at the end (see `resolved_type`).
+
+    Min/max, counts and list lengths are always exact. Value frequencies and the distinct count are
+    exact while the field has at most `max_tracked` distinct values, and come from sketches past
+    that: Misra-Gries for the most frequent values and HyperLogLog for the distinct count. Hashing
+    every value is a large part of profiling time, so the HyperLogLog is only started once the
+    exact counts overflow, from the values counted so far.
+    """
+
+    def __init__(self, max_tracked=MAX_TRACKED_VALUES, hll_precision=HLL_PRECISION):
+        self.count = 0
+        # Stats per value type, in the order the types were first seen
+        self.types = {}
+        self.values = MisraGries(max_tracked)
+        # None while `values` is exact
+        self.distinct = None
+        self.hll_precision = hll_precision
+        # Lists with unhashable items (e.g. nested objects) can't be counted and are skipped
+        self.unhashable = False
+
+    def _exact_distinct(self) -> HyperLogLog:
+        # HyperLogLog of the values counted so far, which are all of them while counts are exact
+        sketch = HyperLogLog(self.hll_precision)
+        for value in self.values.counts:
+            sketch.add(value)
+        return sketch
+
+    def _track(self, value):
+        if self.distinct is None:
+            counts = self.values.counts
+            if value in counts or len(counts) < self.values.capacity:
+                self.values.add(value)
+                return
+            # About to overflow, which drops values from the counts
+            self.distinct = self._exact_distinct()
+        self.values.add(value)
+        self.distinct.add(value)
+
+    def add(self, value):
+        if value is None:
+            return
+        value_type, bound = classify(value)
+        if value_type not in self.types:
+            self.types[value_type] = TypeStats()
+        self.types[value_type].add(bound)
+        self.count += 1
+        if value_type != "list":
+            self._track(value)
+        elif not self.unhashable:
+            try:
+                for item in value:
+                    self._track(item)
+            except TypeError:
+                self.unhashable = True
+
+    def merge(self, other):
+        """
+        Fold the statistics of the same field from another shard into this profile.
+        """
+        for value_type, stats in other.types.items():
+            if value_type not in self.types:
+                self.types[value_type] = TypeStats()
+            self.types[value_type].merge(stats)
+        self.count += other.count
+        self.unhashable = self.unhashable or other.unhashable
+        # Sketches are needed if either side has one, or the merged counts will overflow; they have
+        # to be seeded before merging the counts drops values
+        if (
+            self.distinct is not None
+            or other.distinct is not None
+            or len(self.values.counts.keys() | other.values.counts.keys()) > self.values.capacity
+        ):
+            if self.distinct is None:
+                self.distinct = self._exact_distinct()
+            self.distinct.merge(other.distinct if other.distinct is not None else other._exact_distinct())
+        self.values.merge(other.values)
+
+    def to_partial(self):
+        return {
+            "count": self.count,
+            "types": {t: stats.to_partial() for t, stats in self.types.items()},
+            "values": self.values.to_partial(),
+            "distinct": self.distinct.to_partial() if self.distinct is not None else None,
+            "unhashable": self.unhashable,
+        }
+
+    @classmethod
+    def from_partial(cls, partial, hll_precision=HLL_PRECISION):
+        result = cls(hll_precision=hll_precision)
+        result.count = partial["count"]
+        result.types = {t: TypeStats.from_partial(stats) for t, stats in partial["types"].items()}
+        result.values = MisraGries.from_partial(partial["values"])
+        if partial["distinct"] is not None:
+            result.distinct = HyperLogLog.from_partial(partial["distinct"])
+        result.unhashable = partial["unhashable"]
+        return result
+
+    def resolved_type(self):
+        """
+        The type of the field as a whole. Ints mixed with floats are floats, otherwise a mixed field
+        takes its most common type (e.g. a time field with a few malformed timestamps is a time).
+        """
+        types = set(self.types)
+        if not types:
+            return "none"
+        if len(types) == 1:
+            return next(iter(types))
+        if types <= {"int", "float"}:
+            return "float"
+        return max(self.types, key=lambda t: self.types[t].count)
+
+    def bounds(self, value_type):
+        stats = [self.types[t] for t in self.types if t == value_type or (value_type, t) == ("float", "int")]
+        return min(s.min for s in stats), max(s.max for s in stats)
+
+    def distinct_count(self) -> int:
+        if self.values.exact:
+            return len(self.values.counts)
+        return round(self.distinct.estimate())
+
+    def is_unique(self) -> bool:
+        counts = self.values.counts
+        if any(c > 1 for c in counts.values()):
+            # Counts never overestimate, so this value definitely repeats
+            return False
+        if self.values.exact:
+            return True
+        # Allow for three standard errors of the estimate before calling the field non-unique
+        return self.distinct.estimate() >= self.values.total * (1 - 3 * self.distinct.relative_error)
+
+    def to_schema(self, record_count):
+        """
+        Schema entry for this field, or None if the field can't be described. `exact` records
+        whether the value statistics (values, distinct, unique) are exact or estimated, and
+        `mixed_types` counts the values of each type when there's more than one.
+        """
+        nullable = self.count < record_count
+        match self.resolved_type():
             case "time":
-                result[key] = {
+                (min_epoch, min_raw), (max_epoch, max_raw) = self.bounds("time")
+                result = {
                     "type": "time",
-                    "min": min(values),
-                    "max": max(values),
+                    "min": min_raw,
+                    "max": max_raw,
+                    "min_epoch": min_epoch,
+                    "max_epoch": max_epoch,
                     "nullable": nullable,
+                    "exact": True,
                 }
             case "str":
-                ctr = Counter(values)
-                if len(ctr) <= 10:
-                    result[key] = {
+                distinct = self.distinct_count()
+                if distinct <= 10:
+                    result = {
                         "type": "keyword",
-                        "values": sorted(ctr),
+                        "values": sorted(v for v in self.values.counts if isinstance(v, str)),
                         "nullable": nullable,
+                        "distinct": distinct,
+                        "exact": self.values.exact,
                     }
                 else:
-                    examples = sorted(ctr.keys(), key=lambda k: ctr[k], reverse=True)[
-                        :10
-                    ]
-                    result[key] = {
+                    result = {
                         "type": "text",
-                        "values": examples,
+                        "values": [v for v in self.values.top(10) if isinstance(v, str)],
                         "nullable": nullable,
-                        "unique": max(ctr.values()) == 1,
+                        "unique": self.is_unique(),
+                        "distinct": distinct,
+                        "exact": self.values.exact,
                     }
-            case "int":
-                values = list(map(int, values))
-                ctr = Counter(values)
-                result[key] = {
-                    "type": "int",
-                    "min": min(values),
-                    "max": max(values),
-                    "nullable": nullable,
-                    "unique": max(ctr.values()) == 1,
-                }
-            case "float":
-                values = list(map(float ,values))
-                ctr = Counter(values)
-                result[key] = {
-                    "type": "float",
-                    "min": min(values),
-                    "max": max(values),
+            case "int" | "float" | "bool" as value_type:
+                vmin, vmax = self.bounds(value_type)
+                result = {
+                    "type": value_type,
+                    "min": vmin,
+                    "max": vmax,
                     "nullable": nullable,
-                    "unique": max(ctr.values()) == 1,
-                }
-            case "bool":
-                values = list(map(bool, values))
-                ctr = Counter(values)
-                result[key] = {
-                    "type": "bool",
-                    "min": min(values),
-                    "max": max(values),
-                    "nullable": nullable,
-                    "unique": max(ctr.values()) == 1,
+                    "unique": self.is_unique(),
+                    "distinct": self.distinct_count(),
+                    "exact": self.values.exact,
                 }
             case "list":
-                try:
-                    ctr = Counter(v for l in values for v in l)
-                except:
-                    continue
-                max_len = max(len(l) for l in values)
-                min_len = min(len(l) for l in values)
-                if len(ctr) <= 10:
-                    item_set = sorted(ctr)
-                else:
-                    item_set = sorted(ctr.keys(), key=lambda k: ctr[k], reverse=True)[
-                        :10
-                    ]
-                result[key] = {
+                if self.unhashable:
+                    return None
+                counts = self.values.counts
+                min_len, max_len = self.bounds("list")
+                result = {
                     "type": "list",
-                    "items": item_set,
+                    "items": sorted(counts) if len(counts) <= 10 else self.values.top(10),
                     "min_len": min_len,
                     "max_len": max_len,
                     "nullable": nullable,
+                    "distinct": self.distinct_count(),
+                    "exact": self.values.exact,
                 }
             case "none":
-                result[key] = {"type": "none"}
+                return {"type": "none"}
+        if len(self.types) > 1:
+            result["mixed_types"] = {t: stats.count for t, stats in self.types.items()}
+        return result
+
+
+class SchemaProfile:
+    """
+    Running statistics for every field seen in a stream of records. Memory use depends on the
+    number of fields, not the number of records.
+    """
+
+    def __init__(self, max_tracked=MAX_TRACKED_VALUES, hll_precision=HLL_PRECISION):
+        self.record_count = 0
+        self.fields = {}
+        self.max_tracked = max_tracked
+        self.hll_precision = hll_precision
+
+    def add_value(self, key, value):
+        if key not in self.fields:
+            self.fields[key] = FieldProfile(self.max_tracked, self.hll_precision)
+        self.fields[key].add(value)
+
+    def add_record(self, record):
+        self.record_count += 1
+        scan_record(record, self)
+
+    def merge(self, other):
+        self.record_count += other.record_count
+        for key, field in other.fields.items():
+            if key not in self.fields:
+                self.fields[key] = FieldProfile(self.max_tracked, self.hll_precision)
+            self.fields[key].merge(field)
+
+    def to_partial(self):
+        """
+        JSON-serializable form of the profile, which can be merged with other partials later.
+        """
+        return {
+            "partial_schema": PARTIAL_SCHEMA_VERSION,
+            "record_count": self.record_count,
+            "fields": {key: field.to_partial() for key, field in self.fields.items()},
+        }
+
+    @classmethod
+    def from_partial(cls, partial, max_tracked=MAX_TRACKED_VALUES, hll_precision=HLL_PRECISION):
+        if partial.get("partial_schema") != PARTIAL_SCHEMA_VERSION:
+            raise ValueError(f"unsupported partial schema version: {partial.get('partial_schema')}")
+        result = cls(max_tracked, hll_precision)
+        result.record_count = partial["record_count"]
+        for key, field in partial["fields"].items():
+            result.fields[key] = FieldProfile.from_partial(field, hll_precision)
+        return result
+
+    def to_schema(self):
+        result = {}
+        for key, field in self.fields.items():
+            entry = field.to_schema(self.record_count)
+            if entry is not None:
+                result[key] = entry
+        return result
+
+
+def find_schema(records, max_tracked=MAX_TRACKED_VALUES, hll_precision=HLL_PRECISION):
+    profile = SchemaProfile(max_tracked, hll_precision)
+    for record in records:
+        profile.add_record(record)
+    return profile.to_schema()
+
+
+def plan_shards(paths, shard_size=SHARD_SIZE):
+    """
+    Split the inputs into independently profiled shards of `(path, start, end)`. Directories are
+    expanded to the files in them, and NDJSON files are split into byte ranges of about
+    `shard_size`. JSON arrays and partial profiles are always a single shard.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if not name.startswith(".") and os.path.isfile(os.path.join(path, name))
+            )
+        else:
+            files.append(path)
+
+    shards = []
+    for path in files:
+        size = os.path.getsize(path)
+        if path.endswith(PARTIAL_SUFFIX) or size <= shard_size or not is_ndjson(path):
+            shards.append((path, 0, None))
+            continue
+        shards += [(path, start, min(start + shard_size, size)) for start in range(0, size, shard_size)]
+    return shards
+
+
+def profile_shard(shard, max_tracked=MAX_TRACKED_VALUES, hll_precision=HLL_PRECISION):
+    path, start, end = shard
+    if path.endswith(PARTIAL_SUFFIX):
+        with open(path, "r") as in_file:
+            profile = SchemaProfile.from_partial(json.load(in_file), max_tracked, hll_precision)
+        # Distinct count sketches only merge at the same precision
+        for field in profile.fields.values():
+            if field.distinct is not None and field.distinct.precision != hll_precision:
+                raise ValueError(
+                    f"{path} was profiled with HyperLogLog precision {field.distinct.precision}, "
+                    f"but this run uses {hll_precision}; pass --hll-precision {field.distinct.precision}"
+                )
+        return profile
+    profile = SchemaProfile(max_tracked, hll_precision)
+    records = iter_records(path) if end is None else iter_record_range(path, start, end)
+    for record in records:
+        profile.add_record(record)
+    return profile
+
+
+def profile_shards(shards, max_tracked=MAX_TRACKED_VALUES, hll_precision=HLL_PRECISION, processes=1):
+    """
+    Profile each shard, on a process pool if `processes > 1`, and merge the partial profiles in
+    shard order.
+    """
+    result = SchemaProfile(max_tracked, hll_precision)
+    if processes <= 1:
+        for shard in shards:
+            result.merge(profile_shard(shard, max_tracked, hll_precision))
+        return result
+    profile = functools.partial(profile_shard, max_tracked=max_tracked, hll_precision=hll_precision)
+    with ProcessPoolExecutor(processes) as executor:
+        for _, partial in bounded_map(executor, profile, shards, 2 * processes):
+            result.merge(partial)
     return result
 
 
@@ -150,22 +534,55 @@ def escape_schema(schema):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: make_schema.py [input data file] [output schema file]")
-        sys.exit(1)
-    DATA_FILE = sys.argv[1]
-    SCHEMA_FILE = sys.argv[2]
-
-    with open(DATA_FILE, "r") as in_file:
-        records = json.load(in_file)
-
-    # Try to automatically detect and transform data exported directly from an OS index
-    if "_source" in records[0] and "_index" in records[0]:
-        records = [record["_source"] for record in records]
-    
-    agg_records = columnar_aggregate_records(records)
-    schema = find_schema(agg_records)
-    schema = escape_schema(schema)
-
-    with open(SCHEMA_FILE, "w") as out_file:
-        json.dump(schema, out_file, indent=2)
+    parser = argparse.ArgumentParser(description="Generate a schema file from sample data.")
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="JSON array or NDJSON files of records (optionally exported from an OS index), "
+        f"directories of them, or `*{PARTIAL_SUFFIX}` profiles to merge",
+    )
+    parser.add_argument("schema_file")
+    parser.add_argument(
+        "--max-tracked-values",
+        type=int,
+        default=MAX_TRACKED_VALUES,
+        help="distinct values counted exactly per field; past that, counts of frequent values are "
+        f"off by at most 1/(N+1) of the field's values (default {MAX_TRACKED_VALUES})",
+    )
+    parser.add_argument(
+        "--hll-precision",
+        type=int,
+        default=HLL_PRECISION,
+        help="HyperLogLog precision P for distinct counts, with about 1.04/sqrt(2^P) relative "
+        f"error and 2^P bytes per field (default {HLL_PRECISION})",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="number of processes to profile shards with (default: all cores)",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=SHARD_SIZE,
+        help=f"approximate size in bytes of NDJSON shards (default {SHARD_SIZE})",
+    )
+    parser.add_argument(
+        "--partial",
+        action="store_true",
+        help=f"write a mergeable partial profile instead of a schema (name it `*{PARTIAL_SUFFIX}`)",
+    )
+    args = parser.parse_args()
+
+    shards = plan_shards(args.inputs, args.shard_size)
+    try:
+        profile = profile_shards(shards, args.max_tracked_values, args.hll_precision, args.processes)
+    except ValueError as e:
+        parser.error(str(e))
+
+    with open(args.schema_file, "w") as out_file:
+        if args.partial:
+            json.dump(profile.to_partial(), out_file)
+        else:
+            json.dump(escape_schema(profile.to_schema()), out_file, indent=2)
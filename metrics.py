@@ -0,0 +1,90 @@
+"""
+Counters and timers for query generation, showing which commands cost the most attempts and
+time. Metrics are collected per schema, can be merged across worker processes, and are reported
+as a text summary or dumped as JSON.
+"""
+
+
+class CommandStats:
+    """
+    Counts for one command: how often it was drawn, how often its precondition ruled it out of a
+    segment it was otherwise allowed in, and the total time spent generating it.
+    """
+
+    def __init__(self):
+        self.attempts = 0
+        self.infeasible = 0
+        self.seconds = 0.0
+
+    def merge(self, other):
+        self.attempts += other.attempts
+        self.infeasible += other.infeasible
+        self.seconds += other.seconds
+
+    def to_dict(self):
+        return {
+            "attempts": self.attempts,
+            "infeasible": self.infeasible,
+            "seconds": self.seconds,
+            "mean_us_per_attempt": self.seconds / self.attempts * 1e6 if self.attempts > 0 else 0.0,
+        }
+
+
+class GenerationMetrics:
+    """
+    Metrics for the queries generated against one schema. A query is truncated when it ends
+    before its chosen number of segments, either at a dead end (no command allowed in the next
+    segment was feasible) or because no fields were left.
+    """
+
+    def __init__(self, schema: str):
+        self.schema = schema
+        self.queries = 0
+        self.segments = 0
+        self.dead_ends = 0
+        self.emptied = 0
+        self.seconds = 0.0
+        self.commands = {}
+
+    def command(self, name: str) -> CommandStats:
+        if name not in self.commands:
+            self.commands[name] = CommandStats()
+        return self.commands[name]
+
+    def merge(self, other):
+        self.queries += other.queries
+        self.segments += other.segments
+        self.dead_ends += other.dead_ends
+        self.emptied += other.emptied
+        self.seconds += other.seconds
+        for name, stats in other.commands.items():
+            self.command(name).merge(stats)
+
+    def to_dict(self):
+        return {
+            "schema": self.schema,
+            "queries": self.queries,
+            "segments": self.segments,
+            "dead_ends": self.dead_ends,
+            "emptied": self.emptied,
+            "seconds": self.seconds,
+            "commands": {name: self.commands[name].to_dict() for name in sorted(self.commands)},
+        }
+
+    def summary(self) -> str:
+        truncated = self.dead_ends + self.emptied
+        rate = truncated / self.queries if self.queries > 0 else 0.0
+        mean = self.seconds / self.queries * 1e6 if self.queries > 0 else 0.0
+        lines = [
+            f"Generation of {self.queries} queries for {self.schema}: {self.segments} segments, "
+            f"{mean:.1f}us per query, {truncated} truncated ({rate:.1%}: {self.dead_ends} dead ends, "
+            f"{self.emptied} out of fields)",
+            f"  {'command':<8} {'attempts':>9} {'infeasible':>10} {'us/attempt':>11} {'total s':>8}",
+        ]
+        # Most expensive commands first
+        for name, stats in sorted(self.commands.items(), key=lambda item: -item[1].seconds):
+            per_attempt = stats.seconds / stats.attempts * 1e6 if stats.attempts > 0 else 0.0
+            lines.append(
+                f"  {name:<8} {stats.attempts:>9} {stats.infeasible:>10} {per_attempt:>11.1f} {stats.seconds:>8.3f}"
+            )
+        return "\n".join(lines)
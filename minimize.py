@@ -0,0 +1,228 @@
+"""
+Minimize failing queries with delta debugging. A query is split into its `|` segments, and each
+`where` condition into its AND/OR/XOR terms, and delta debugging removes as many of them as it can
+while the query still fails with the same error class (status code and error type). Segments are
+reduced first, then the terms of each `where` left, repeating until neither shrinks.
+
+Each round's candidate queries are checked against the cluster concurrently, several failing
+queries are minimized at once, and every check is memoized (and cached across runs with
+`--cache`), so queries sharing a prefix don't repeat work.
+
+Usage: minimize.py [--max-in-flight 16] < failures.txt
+
+Input is one query per line, or the stderr of gen_queries.py: `> Query: ...` lines are read and
+other lines skipped. Each minimized query is printed as a JSON line with the original query and
+its error, in input order.
+"""
+
+import argparse
+import functools
+import json
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import bounded_map
+from query_cache import LITERAL_RE, ResultCache, cluster_identity
+from verify_query import VERIFY_MODES, make_client, run_cached_ppl_query
+
+CONNECTIVE_RE = re.compile(r"\s+(AND|OR|XOR)\s+", re.IGNORECASE)
+QUERY_PREFIX = "> Query: "
+
+
+def mask_literals(text: str) -> str:
+    # Same length as `text`, with literal contents blanked, so separators inside them aren't matched
+    return LITERAL_RE.sub(lambda match: match.group()[0] + "_" * (len(match.group()) - 2) + match.group()[-1], text)
+
+
+def split_pipes(ppl_query: str) -> list[str]:
+    """
+    The `|` separated parts of a query, starting with the `source = ...` part.
+    """
+    masked = mask_literals(ppl_query)
+    parts, pos = [], 0
+    for idx, char in enumerate(masked):
+        if char == "|":
+            parts.append(ppl_query[pos:idx].strip())
+            pos = idx + 1
+    parts.append(ppl_query[pos:].strip())
+    return parts
+
+
+def split_terms(condition: str) -> tuple[list[str], list[str]]:
+    """
+    The terms of a condition joined by AND/OR/XOR outside parentheses, and the connectives between
+    them. `a = 1 AND b = 2` gives `(["a = 1", "b = 2"], ["AND"])`.
+    """
+    masked = mask_literals(condition)
+    terms, connectives, pos = [], [], 0
+    for match in CONNECTIVE_RE.finditer(masked):
+        prefix = masked[: match.start()]
+        if prefix.count("(") != prefix.count(")"):
+            continue
+        terms.append(condition[pos : match.start()].strip())
+        connectives.append(match.group(1))
+        pos = match.end()
+    terms.append(condition[pos:].strip())
+    return terms, connectives
+
+
+def join_terms(terms: list[str], connectives: list[str], keep: list[int]) -> str:
+    # Each kept term keeps the connective before it; the first kept term needs none
+    result = terms[keep[0]]
+    for idx in keep[1:]:
+        result += f" {connectives[idx - 1]} {terms[idx]}"
+    return result
+
+
+def ddmin(items: list, fails) -> list:
+    """
+    Delta debugging: a 1-minimal subsequence of `items` for which `fails` holds, assuming it holds
+    for `items`. `fails` takes a list of candidates and returns which of them fail, so a whole round
+    of candidates can be checked at once.
+    """
+    n = 2
+    while len(items) >= 2:
+        size = len(items) / n
+        chunks = [items[round(i * size) : round((i + 1) * size)] for i in range(n)]
+        candidates = chunks
+        if n > 2:
+            # With two chunks, the complements are the chunks
+            candidates = chunks + [items[: round(i * size)] + items[round((i + 1) * size) :] for i in range(n)]
+        results = fails(candidates)
+        if any(results[:n]):
+            # Reduce to a subset
+            items, n = chunks[results.index(True)], 2
+        elif any(results[n:]):
+            # Reduce to a complement
+            items, n = candidates[results.index(True, n)], max(n - 1, 2)
+        elif n >= len(items):
+            break
+        else:
+            n = min(len(items), 2 * n)
+    return items
+
+
+class Minimizer:
+    """
+    Minimizes queries with `check`, which runs a query and returns its error class, or None if it
+    succeeds. Checks are run on `executor`, and memoized: a query already checked, or being checked
+    by another minimization, isn't sent again.
+    """
+
+    def __init__(self, check, executor):
+        self.check = check
+        self.executor = executor
+        self.checks = {}
+        self._lock = threading.Lock()
+
+    def error_class(self, ppl_query: str):
+        return self._submit(ppl_query).result()
+
+    def _submit(self, ppl_query: str):
+        with self._lock:
+            if ppl_query not in self.checks:
+                self.checks[ppl_query] = self.executor.submit(self.check, ppl_query)
+            return self.checks[ppl_query]
+
+    def _fails_as(self, error, build):
+        # `ddmin` oracle: checks a round of candidates concurrently, built into queries by `build`
+        def fails(candidates):
+            futures = [self._submit(build(candidate)) for candidate in candidates]
+            return [future.result() == error for future in futures]
+
+        return fails
+
+    def minimize(self, ppl_query: str) -> tuple[str, object]:
+        """
+        The smallest query found that fails with the same error class as `ppl_query`, and that error
+        class. Queries that succeed are returned as they are, with None.
+        """
+        error = self.error_class(ppl_query)
+        if error is None:
+            return ppl_query, None
+        source, *segments = split_pipes(ppl_query)
+        build_query = lambda parts: " | ".join([source, *parts])
+        changed = True
+        while changed:
+            reduced = ddmin(segments, self._fails_as(error, build_query))
+            changed = len(reduced) < len(segments)
+            segments = reduced
+            for idx, segment in enumerate(segments):
+                command, _, condition = segment.partition(" ")
+                if command.lower() != "where":
+                    continue
+                terms, connectives = split_terms(condition)
+                build_where = lambda keep: build_query(
+                    segments[:idx] + [f"{command} {join_terms(terms, connectives, keep)}"] + segments[idx + 1 :]
+                )
+                keep = ddmin(list(range(len(terms))), self._fails_as(error, build_where))
+                if len(keep) < len(terms):
+                    segments = segments[:idx] + [f"{command} {join_terms(terms, connectives, keep)}"] + segments[idx + 1 :]
+                    changed = True
+        return build_query(segments), error
+
+
+def cluster_check(client, cache: ResultCache | None, mode: str, ppl_query: str):
+    result = run_cached_ppl_query(client, cache, ppl_query, mode)
+    if result["success"]:
+        return None
+    return (result["status_code"], result["error"])
+
+
+def read_queries(lines):
+    # Queries on their own, or as reported by `verify_query.report`; other lines are skipped
+    for line in lines:
+        line = line.strip()
+        if line.startswith(QUERY_PREFIX):
+            line = line[len(QUERY_PREFIX) :]
+        if line.startswith("source"):
+            yield line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Minimize failing PPL queries with delta debugging.")
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=16,
+        help="maximum number of checks outstanding against the cluster at once (default 16)",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=4, help="number of queries minimized at once (default 4)"
+    )
+    parser.add_argument("--cache", default=None, help="SQLite file caching check results across runs")
+    parser.add_argument("--cache-size", type=int, default=1_000_000, help="maximum number of cached results")
+    parser.add_argument("--mode", choices=VERIFY_MODES, default="run", help="how queries are checked (default run)")
+    args = parser.parse_args()
+    if args.max_in_flight < 1:
+        parser.error("--max-in-flight must be at least 1")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    client = make_client(pool_maxsize=args.max_in_flight)
+    cache = None
+    if args.cache is not None:
+        cache = ResultCache(args.cache, f"{cluster_identity(client)}#{args.mode}", args.cache_size)
+
+    total, minimized, segments_before, segments_after = 0, 0, 0, 0
+    with ThreadPoolExecutor(max_workers=args.max_in_flight) as checks, ThreadPoolExecutor(args.jobs) as jobs:
+        minimizer = Minimizer(functools.partial(cluster_check, client, cache, args.mode), checks)
+        for ppl_query, (result, error) in bounded_map(jobs, minimizer.minimize, read_queries(sys.stdin), 2 * args.jobs):
+            total += 1
+            if error is None:
+                print(f"Query doesn't fail, skipped:\n> Query: {ppl_query}", file=sys.stderr)
+                continue
+            minimized += 1
+            segments_before += len(split_pipes(ppl_query)) - 1
+            segments_after += len(split_pipes(result)) - 1
+            print(json.dumps({"query": ppl_query, "minimized": result, "status": error[0], "error": error[1]}), flush=True)
+
+    print(
+        f"Minimized {minimized} of {total} queries from {segments_before} to {segments_after} commands, "
+        f"with {len(minimizer.checks)} distinct checks",
+        file=sys.stderr,
+    )
+    if cache is not None:
+        print(cache.summary(), file=sys.stderr)
+        cache.close()
@@ -0,0 +1,217 @@
+"""
+Spreading verification across the nodes of a cluster. The client's transport already keeps one
+connection per node, retries failed requests on another node and takes failing nodes out of
+rotation for a while (doubling each time they fail again). This module plugs into it:
+
+- `TrackedConnection` records per-node latency, query errors and node failures.
+- `RoundRobinSelector` and `LeastOutstandingSelector` pick the node for each request.
+- `EjectingConnectionPool` counts how often each node was taken out of rotation.
+
+A query error is a response rejecting the query (4xx), which says nothing about the node. A node
+failure is a connection error, timeout or 5xx, and 502/503/504s and connection errors eject the
+node.
+"""
+
+import itertools
+import threading
+import time
+from opensearchpy import ConnectionPool, OpenSearch, Urllib3HttpConnection
+from opensearchpy.connection_pool import ConnectionSelector
+from opensearchpy.exceptions import ConnectionError, TransportError
+from sketches import LatencyHistogram
+
+DEFAULT_PORT = 443
+# Seconds a failing node is out of rotation the first time, doubling each further failure in a row
+DEFAULT_DEAD_TIMEOUT = 60
+
+
+def parse_hosts(conf: dict) -> list[dict]:
+    """
+    Nodes listed in a client config: `hosts` is a list of `"host"`, `"host:port"` or
+    `{"host": ..., "port": ...}` entries, or a single `host` is given. Nodes without a port use
+    `port` from the config, or 443.
+    """
+    default_port = conf.get("port", DEFAULT_PORT)
+    entries = conf["hosts"] if "hosts" in conf else [conf["host"]]
+    hosts = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            hosts.append({"host": entry["host"], "port": int(entry.get("port", default_port))})
+        else:
+            host, _, port = entry.rpartition(":") if ":" in entry else (entry, None, None)
+            hosts.append({"host": host, "port": int(port) if port else default_port})
+    return hosts
+
+
+def is_node_failure(error: TransportError) -> bool:
+    # Connection errors (including timeouts) have no status code
+    return isinstance(error, ConnectionError) or not isinstance(error.status_code, int) or error.status_code >= 500
+
+
+class NodeStats:
+    """
+    Counters for the requests sent to one node. Updated from every verification thread.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.query_errors = 0
+        self.failures = 0
+        self.ejections = 0
+        self.outstanding = 0
+        self.latency = LatencyHistogram()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.outstanding += 1
+
+    def finish(self, seconds: float, outcome: str):
+        """
+        Record a request that ended in `outcome`: "ok", "query_error" or "failure".
+        """
+        with self._lock:
+            self.outstanding -= 1
+            self.requests += 1
+            if outcome == "failure":
+                self.failures += 1
+                return
+            # Rejected queries still took a full round trip to the node
+            self.latency.record(seconds)
+            if outcome == "query_error":
+                self.query_errors += 1
+
+    def eject(self):
+        with self._lock:
+            self.ejections += 1
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "query_errors": self.query_errors,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "latency": self.latency.summary(),
+        }
+
+
+class TrackedConnection(Urllib3HttpConnection):
+    """
+    Connection to one node that keeps `NodeStats` for the requests sent over it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = NodeStats()
+
+    def perform_request(self, *args, **kwargs):
+        self.stats.start()
+        start = time.perf_counter()
+        outcome = "failure"
+        try:
+            result = super().perform_request(*args, **kwargs)
+            outcome = "ok"
+            return result
+        except TransportError as error:
+            if not is_node_failure(error):
+                outcome = "query_error"
+            raise
+        finally:
+            self.stats.finish(time.perf_counter() - start, outcome)
+
+
+class RoundRobinSelector(ConnectionSelector):
+    """
+    Nodes in turn. Unlike the client's default round robin, which keeps a position per thread, the
+    position is shared, so concurrent verification threads don't all start on the first node.
+    """
+
+    def __init__(self, opts):
+        super().__init__(opts)
+        self._next = itertools.count()
+
+    def select(self, connections):
+        return connections[next(self._next) % len(connections)]
+
+
+class LeastOutstandingSelector(ConnectionSelector):
+    """
+    The node with the fewest requests in flight, so slow nodes get less of the load. Ties go round
+    robin.
+    """
+
+    def __init__(self, opts):
+        super().__init__(opts)
+        self._next = itertools.count()
+
+    def select(self, connections):
+        offset = next(self._next)
+        rotated = [connections[(offset + i) % len(connections)] for i in range(len(connections))]
+        return min(rotated, key=lambda connection: connection.stats.outstanding)
+
+
+SELECTORS = {"round-robin": RoundRobinSelector, "least-outstanding": LeastOutstandingSelector}
+
+
+class EjectingConnectionPool(ConnectionPool):
+    """
+    Connection pool counting each time a live node is taken out of rotation.
+    """
+
+    def mark_dead(self, connection, now=None):
+        if connection in self.connections and hasattr(connection, "stats"):
+            connection.stats.eject()
+        super().mark_dead(connection, now)
+
+
+def make_node_client(
+    hosts: list[dict],
+    balance: str = "round-robin",
+    pool_maxsize: int = 10,
+    dead_timeout: float = DEFAULT_DEAD_TIMEOUT,
+    **kwargs,
+) -> OpenSearch:
+    """
+    Client spreading requests over `hosts` with the `balance` selector (see `SELECTORS`), keeping
+    `NodeStats` per node. Each node gets a connection pool `pool_maxsize` wide. Other arguments are
+    passed on to `OpenSearch`.
+    """
+    return OpenSearch(
+        hosts=hosts,
+        connection_class=TrackedConnection,
+        connection_pool_class=EjectingConnectionPool,
+        selector_class=SELECTORS[balance],
+        dead_timeout=dead_timeout,
+        pool_maxsize=pool_maxsize,
+        **kwargs,
+    )
+
+
+def node_connections(client) -> list:
+    return [connection for connection, _ in client.transport.connection_pool.connection_opts]
+
+
+def nodes_summary(client) -> str | None:
+    """
+    Per-node request counts, error rates and latency percentiles, or None if the client's
+    connections don't keep stats.
+    """
+    connections = node_connections(client)
+    if not all(hasattr(connection, "stats") for connection in connections):
+        return None
+    live = client.transport.connection_pool.connections
+    lines = [
+        f"  {'node':<30} {'requests':>8} {'query err':>9} {'failed':>7} {'ejected':>7} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+    ]
+    for connection in connections:
+        stats = connection.stats
+        latency = stats.latency.summary()
+        query_error_rate = stats.query_errors / stats.requests if stats.requests > 0 else 0.0
+        failure_rate = stats.failures / stats.requests if stats.requests > 0 else 0.0
+        name = connection.host + ("" if connection in live else " (out)")
+        lines.append(
+            f"  {name:<30} {stats.requests:>8} {query_error_rate:>9.1%} {failure_rate:>7.1%} {stats.ejections:>7} "
+            f"{latency['p50_ms']:>8.1f} {latency['p95_ms']:>8.1f} {latency['p99_ms']:>8.1f} {latency['max_ms']:>8.1f}"
+        )
+    return "Nodes:\n" + "\n".join(lines)
@@ -0,0 +1,23 @@
+"""
+Small helpers for chaining lazy stages together. Each stage consumes an iterable and yields
+results, so a run of any length holds only a bounded number of items in memory at once.
+"""
+
+from collections import deque
+
+
+def bounded_map(executor, fn, items, limit: int):
+    """
+    Like `executor.map(fn, items)`, but lazy: `items` is only consumed as results are taken, and at
+    most `limit` calls are submitted but not yet yielded. Results are yielded in input order as
+    `(item, result)` pairs. A slow consumer therefore applies backpressure all the way upstream.
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= limit:
+            done_item, future = pending.popleft()
+            yield done_item, future.result()
+        pending.append((item, executor.submit(fn, item)))
+    while pending:
+        done_item, future = pending.popleft()
+        yield done_item, future.result()
@@ -0,0 +1,121 @@
+"""
+Persistent cache of verification results, so queries the cluster has already accepted or rejected
+aren't sent again on later runs. Results are stored in SQLite, keyed by the normalized query and
+the identity of the cluster that ran it.
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+# String literals are kept as-is when normalizing, everything between them is tokenized
+LITERAL_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`")
+
+
+def normalize_query(ppl_query: str) -> str:
+    """
+    Canonical form of a query, so queries that only differ in whitespace outside of literals are
+    treated the same.
+    """
+    parts, pos = [], 0
+    for match in LITERAL_RE.finditer(ppl_query):
+        parts.append(" ".join(ppl_query[pos : match.start()].split()))
+        parts.append(match.group())
+        pos = match.end()
+    parts.append(" ".join(ppl_query[pos:].split()))
+    return " ".join(p for p in parts if p)
+
+
+def cluster_identity(client) -> str:
+    """
+    Identifies the cluster and version a result came from. Results from one cluster or version
+    aren't reused for another, since the PPL engine's behavior changes between them.
+    """
+    info = client.info()
+    return f"{info['cluster_name']}/{info['cluster_uuid']}@{info['version']['number']}"
+
+
+class ResultCache:
+    """
+    LRU cache of verification results, holding at most `max_entries` results. Safe to share
+    between verification threads.
+    """
+
+    def __init__(self, path: str, cluster_id: str, max_entries: int = 1_000_000):
+        self.cluster_id = cluster_id
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                success INTEGER NOT NULL,
+                status_code INTEGER,
+                error TEXT,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self._size = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def _key(self, ppl_query: str) -> str:
+        return hashlib.sha256(f"{self.cluster_id}\0{normalize_query(ppl_query)}".encode()).hexdigest()
+
+    def get(self, ppl_query: str) -> dict | None:
+        key = self._key(ppl_query)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT success, status_code, error FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        success, status_code, error = row
+        result = {"response": None, "success": success, "error": json.loads(error), "cached": True}
+        if not success:
+            result["status_code"] = status_code
+        return result
+
+    def put(self, ppl_query: str, result: dict):
+        # Only cache answers from the PPL engine. Connection failures and timeouts have no status
+        # code, and should be retried next time.
+        if not result["success"] and not isinstance(result.get("status_code"), int):
+            return
+        key = self._key(ppl_query)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?)",
+                (key, result["success"], result.get("status_code"), json.dumps(result["error"]), time.time()),
+            )
+            self._size += cursor.rowcount
+            if self._size > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the bound, so eviction doesn't run again on the very next insert
+        target = int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)",
+            (self._size - target,),
+        )
+        self._size = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total > 0 else 0.0
+        return f"Cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate), {self._size} entries"
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,15 @@
+"""
+The git revision of the working tree, recorded alongside benchmark and load test results so runs
+can be compared across changes.
+"""
+
+import subprocess
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,163 @@
+"""
+Structured output for large runs: one NDJSON record per query, with its schema, seed, commands,
+verification status, error and latency, written to size-bounded shard files instead of stdout.
+
+Records are buffered and written a block at a time, optionally gzip or zstd compressed (zstd needs
+the `zstandard` package). A shard is written under a `.partial` name and only renamed once it's
+complete, and records never span shards, so downstream jobs can pick up finished shards and read
+them in parallel while a run is still going. A manifest listing every shard and its record count
+is written when the run ends.
+"""
+
+import gzip
+import json
+import os
+from query_cache import LITERAL_RE
+
+COMPRESSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def query_commands(ppl_query: str) -> list[str]:
+    """
+    The commands of a query in order, e.g. `["where", "stats"]`. Only the first word of each `|`
+    segment is read, so this is much cheaper than tokenizing the query.
+    """
+    # Literals are blanked first, so a `|` inside one isn't taken for a pipe
+    _, *segments = LITERAL_RE.sub("''", ppl_query).split("|")
+    return [segment.split(maxsplit=1)[0].lower() if segment.strip() else "" for segment in segments]
+
+
+def query_record(ppl_query: str, seed, result: dict | None = None) -> dict:
+    """
+    Output record for a query, verified with `result` (from `verify_query.run_ppl_query`) or only
+    generated if there's no result.
+    """
+    source = ppl_query.partition("|")[0].partition("=")[2].strip()
+    record = {
+        "query": ppl_query,
+        "schema": source.strip("`"),
+        "seed": seed,
+        "commands": query_commands(ppl_query),
+    }
+    if result is None:
+        record["status"] = "generated"
+        return record
+    record["status"] = "ok" if result["success"] else "error"
+    record["status_code"] = result.get("status_code")
+    record["error"] = result["error"]
+    record["cached"] = result.get("cached", False)
+    # Cached results weren't sent, so they have no latency
+    record["latency_ms"] = result["seconds"] * 1000 if "seconds" in result else None
+    return record
+
+
+class ShardedWriter:
+    """
+    Writes NDJSON records to `[directory]/[prefix]-00000.ndjson`, `-00001`, ..., starting a new
+    shard once the current one holds `max_bytes` of records (before compression). Records are
+    written out once `buffer_bytes` of them are waiting. Use as a context manager, or call `close`
+    to flush the last shard and write the manifest.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        prefix: str = "queries",
+        max_bytes: int = 256 * 1024 * 1024,
+        compression: str = "none",
+        buffer_bytes: int = 1024 * 1024,
+    ):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"unknown compression {compression!r}, expected one of {', '.join(COMPRESSIONS)}")
+        if compression == "zstd":
+            # Imported here since zstd is optional; gzip and uncompressed output work without it
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+            self._zstd = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.buffer_bytes = buffer_bytes
+        self.shards = []
+        self.records = 0
+        self._buffer = []
+        self._buffered = 0
+        self._file = None
+        self._shard_bytes = 0
+        self._shard_records = 0
+
+    def _shard_path(self, index: int) -> str:
+        return os.path.join(self.directory, f"{self.prefix}-{index:05d}.ndjson{COMPRESSIONS[self.compression]}")
+
+    def _open_shard(self):
+        path = self._shard_path(len(self.shards)) + ".partial"
+        raw = open(path, "wb")
+        if self.compression == "gzip":
+            self._file = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=GZIP_LEVEL)
+        elif self.compression == "zstd":
+            self._file = self._zstd.stream_writer(raw)
+        else:
+            self._file = raw
+        self._raw = raw
+        self._shard_bytes = 0
+        self._shard_records = 0
+
+    def _close_shard(self):
+        self._file.close()
+        if not self._raw.closed:
+            self._raw.close()
+        path = self._shard_path(len(self.shards))
+        os.replace(path + ".partial", path)
+        self.shards.append({"path": os.path.basename(path), "records": self._shard_records, "bytes": self._shard_bytes})
+        self._file = None
+
+    def _flush(self):
+        # Fill the current shard, starting a new one when the next record doesn't fit. A record
+        # bigger than `max_bytes` on its own gets a shard to itself.
+        pending = self._buffer
+        self._buffer, self._buffered = [], 0
+        start = 0
+        while start < len(pending):
+            if self._file is None:
+                self._open_shard()
+            end, size = start, self._shard_bytes
+            while end < len(pending) and (size + len(pending[end]) <= self.max_bytes or size == 0):
+                size += len(pending[end])
+                end += 1
+            self._file.write(b"".join(pending[start:end]))
+            self._shard_records += end - start
+            self._shard_bytes = size
+            start = end
+            if start < len(pending):
+                self._close_shard()
+
+    def write(self, record: dict):
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode()
+        self._buffer.append(line)
+        self._buffered += len(line)
+        self.records += 1
+        if self._buffered >= self.buffer_bytes:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        if self._file is not None:
+            self._close_shard()
+        manifest = {"records": self.records, "compression": self.compression, "shards": self.shards}
+        with open(os.path.join(self.directory, f"{self.prefix}-manifest.json"), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+    def summary(self) -> str:
+        return f"Wrote {self.records} records to {len(self.shards)} shards in {self.directory}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
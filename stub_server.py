@@ -0,0 +1,145 @@
+"""
+Stand-in for an OpenSearch node's PPL API, for benchmarking and exercising verification without a
+cluster. Every query gets the same small result after an optional delay, and a deterministic
+fraction of queries are rejected with a 400 the way the PPL engine rejects invalid queries. Several
+stub servers can stand in for the nodes of a cluster, and a server can be made unavailable to see
+it taken out of rotation.
+
+Usage: stub_server.py [--port 9200] [--nodes 1] [--latency 0.005] [--error-rate 0.1]
+"""
+
+import argparse
+import gzip
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sketches import stable_hash
+
+INFO = {
+    "name": "stub",
+    "cluster_name": "stub",
+    "cluster_uuid": "stub",
+    "version": {"distribution": "opensearch", "number": "0.0.0-stub"},
+}
+RESULT = {"schema": [{"name": "count()", "type": "integer"}], "datarows": [[1]], "total": 1, "size": 1}
+EXPLAIN = {"root": {"name": "ProjectOperator", "description": {}, "children": []}}
+ERROR = {
+    "error": {"reason": "Invalid Query", "details": "rejected by stub server", "type": "SemanticCheckException"},
+    "status": 400,
+}
+UNAVAILABLE = {
+    "error": {"reason": "stub server marked unavailable", "type": "stub_unavailable_exception"},
+    "status": 503,
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep connections open, like a real node, so the client's connection pool is exercised
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which without this stalls on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_json(200, INFO)
+
+    def do_HEAD(self):
+        self.send_json(200, {})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        self.server.count_request()
+        if self.server.unavailable:
+            self.send_json(503, UNAVAILABLE)
+        elif self.path.startswith("/_plugins/_ppl"):
+            query = json.loads(body)["query"]
+            if self.server.rejects(query):
+                self.send_json(400, ERROR)
+            elif self.path.startswith("/_plugins/_ppl/_explain"):
+                self.send_json(200, EXPLAIN)
+            else:
+                self.send_json(200, RESULT)
+        else:
+            self.send_json(404, {"error": f"no handler for {self.path}", "status": 404})
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Stub PPL server answering each request on its own thread after `latency` seconds. Queries are
+    rejected based on a hash of their text, so about `error_rate` of them fail, and the same query
+    always gets the same answer. While `unavailable` is set, every request gets a 503, which clients
+    treat as a failing node.
+    """
+
+    daemon_threads = True
+    # The default backlog of 5 drops connections when a wide client pool connects all at once
+    request_queue_size = 128
+
+    def __init__(self, address=("127.0.0.1", 0), latency: float = 0.0, error_rate: float = 0.0):
+        super().__init__(address, StubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.unavailable = False
+        self._lock = threading.Lock()
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def rejects(self, ppl_query: str) -> bool:
+        return stable_hash(ppl_query) % 10_000 < self.error_rate * 10_000
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+
+def start_stub_server(latency: float = 0.0, error_rate: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+    """
+    Start a StubServer on a background thread. With `port=0` a free port is picked; read it back
+    from `server.port`. Stop it with `server.shutdown()`.
+    """
+    server = StubServer((host, port), latency, error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a stub OpenSearch PPL API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--nodes", type=int, default=1, help="stub nodes to serve, on consecutive ports (default 1)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before each response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of queries to reject (0-1)")
+    args = parser.parse_args()
+
+    servers = [
+        start_stub_server(args.latency, args.error_rate, args.host, args.port + i) for i in range(args.nodes)
+    ]
+    for server in servers:
+        print(f"Serving stub PPL API on http://{server.host}:{server.port}", file=sys.stderr)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,412 @@
+"""
+Offline validator for the subset of PPL produced by gen_queries.py. Queries are checked against a
+schema without a cluster: fields must exist at the point they're used (tracking `fields`, `rename`,
+`eval`, `parse`, `stats`, `top` and `rare`), operators and literals must fit the field's type, and
+`parse` patterns must be valid regexes. Statically invalid queries can then be dropped before
+spending a cluster round-trip on them.
+
+Usage: validate_query.py [schema] < queries.txt
+"""
+
+import ast
+import datetime
+import json
+import re
+import sys
+from context import TIME_PARTS, Schema
+
+
+class InvalidQuery(Exception):
+    """
+    Raised with the reason a query can't be valid for the schema.
+    """
+
+    pass
+
+
+TOKEN_RE = re.compile(
+    r"""\s*(?:
+        (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+      | (?P<number>-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)(?![\w@.`])
+      | (?P<op>>=|<=|!=|=|<|>|\(|\)|,|\||-|\+)
+      | (?P<name>`[^`]*`|[\w@.][\w@.*-]*)
+    )""",
+    re.VERBOSE,
+)
+
+COMPARISONS = ("=", "!=", "<", "<=", ">", ">=")
+# Literal kinds that can be compared with each field type
+LITERAL_TYPES = {
+    "keyword": {"string"},
+    "text": {"string"},
+    "int": {"number"},
+    "float": {"number"},
+    "time": {"time", "string"},
+    "bool": {"bool"},
+    "list": {"string", "number", "bool"},
+}
+STRING_TYPES = ("keyword", "text")
+NUMERIC_TYPES = ("int", "float")
+# Aggregations usable in `stats`, with the field types they accept (None for any type)
+AGGREGATIONS = {
+    "count": None,
+    "sum": NUMERIC_TYPES,
+    "avg": NUMERIC_TYPES,
+    "min": ("text", "int", "float", "time"),
+    "max": ("text", "int", "float", "time"),
+}
+# Python named groups are `(?P<name>`, PPL's are `(?<name>`. Lookbehinds `(?<=` and `(?<!` aren't groups.
+PPL_GROUP_RE = re.compile(r"\(\?<(?![=!])")
+
+
+def tokenize(ppl_query: str) -> list[tuple[str, str]]:
+    tokens, pos = [], 0
+    while pos < len(ppl_query):
+        if ppl_query[pos:].isspace():
+            break
+        match = TOKEN_RE.match(ppl_query, pos)
+        if match is None:
+            raise InvalidQuery(f"unexpected character {ppl_query[pos]!r} at {pos}")
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        pos = match.end()
+    return tokens
+
+
+def field_name(name: str) -> str:
+    return name.strip("`")
+
+
+class SegmentChecker:
+    """
+    Checks a single `|`-separated command against the fields in scope, updating them to the
+    fields the command leaves for the rest of the query.
+    """
+
+    def __init__(self, tokens, fields: dict[str, str]):
+        self.tokens = tokens
+        self.pos = 0
+        self.fields = fields
+
+    def peek(self, offset=0):
+        idx = self.pos + offset
+        return self.tokens[idx] if idx < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise InvalidQuery("unexpected end of command")
+        self.pos += 1
+        return token
+
+    def accept(self, text):
+        if self.peek()[1] is not None and self.peek()[1].upper() == text.upper() and self.peek()[0] != "string":
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, text):
+        if not self.accept(text):
+            raise InvalidQuery(f"expected {text!r}, found {self.peek()[1]!r}")
+
+    def done(self):
+        if self.pos < len(self.tokens):
+            raise InvalidQuery(f"unexpected {self.peek()[1]!r}")
+
+    def field(self) -> str:
+        kind, text = self.next()
+        if kind != "name":
+            raise InvalidQuery(f"expected a field, found {text!r}")
+        name = field_name(text)
+        if name not in self.fields:
+            raise InvalidQuery(f"field {name} isn't in scope")
+        return name
+
+    def field_list(self) -> list[str]:
+        names = [self.field()]
+        while self.accept(","):
+            names.append(self.field())
+        return names
+
+    def new_name(self) -> str:
+        kind, text = self.next()
+        if kind != "name":
+            raise InvalidQuery(f"expected a name, found {text!r}")
+        return field_name(text)
+
+    def literal(self) -> str:
+        """
+        Consume a literal and return its kind: string, number, bool or time.
+        """
+        kind, text = self.next()
+        if kind == "string":
+            return "string"
+        if kind == "number":
+            return "number"
+        if kind == "name" and text.lower() in ("true", "false"):
+            return "bool"
+        if kind == "name" and text.upper() == "TIMESTAMP":
+            self.expect("(")
+            kind, text = self.next()
+            if kind != "string":
+                raise InvalidQuery(f"TIMESTAMP takes a string, found {text!r}")
+            try:
+                datetime.datetime.fromisoformat(ast.literal_eval(text))
+            except ValueError:
+                raise InvalidQuery(f"invalid timestamp {text}")
+            self.expect(")")
+            return "time"
+        raise InvalidQuery(f"expected a literal, found {text!r}")
+
+    def check_literal(self, name, literal_kind):
+        field_type = self.fields[name]
+        if literal_kind not in LITERAL_TYPES.get(field_type, ()):
+            raise InvalidQuery(f"can't compare {field_type} field {name} with a {literal_kind}")
+
+    # Boolean expressions, for `where`
+
+    def expression(self):
+        self.predicate()
+        while self.accept("AND") or self.accept("OR") or self.accept("XOR"):
+            self.predicate()
+
+    def predicate(self):
+        if self.accept("NOT"):
+            return self.predicate()
+        if self.accept("("):
+            self.expression()
+            return self.expect(")")
+        if self.peek()[1] is not None and self.peek()[1].upper() == "LIKE" and self.peek(1)[1] == "(":
+            self.pos += 2
+            name = self.field()
+            if self.fields[name] not in STRING_TYPES:
+                raise InvalidQuery(f"LIKE on {self.fields[name]} field {name}")
+            self.expect(",")
+            if self.next()[0] != "string":
+                raise InvalidQuery("LIKE pattern must be a string")
+            return self.expect(")")
+
+        name = self.field()
+        kind, op = self.peek()
+        if kind == "op" and op in COMPARISONS:
+            self.pos += 1
+            if self.fields[name] in ("bool", "list") and op not in ("=", "!="):
+                raise InvalidQuery(f"{op} on {self.fields[name]} field {name}")
+            self.check_literal(name, self.literal())
+        elif self.accept("IN"):
+            if self.fields[name] not in STRING_TYPES + NUMERIC_TYPES:
+                raise InvalidQuery(f"IN on {self.fields[name]} field {name}")
+            self.expect("(")
+            self.check_literal(name, self.literal())
+            while self.accept(","):
+                self.check_literal(name, self.literal())
+            self.expect(")")
+        elif self.fields[name] != "bool":
+            raise InvalidQuery(f"{self.fields[name]} field {name} used as a condition")
+
+    # Commands
+
+    def where(self):
+        self.expression()
+
+    def fields_cmd(self):
+        exclude = self.accept("-")
+        if not exclude:
+            self.accept("+")
+        names = self.field_list()
+        if exclude:
+            for name in names:
+                del self.fields[name]
+        else:
+            self.fields = {name: self.fields[name] for name in names}
+
+    def rename(self):
+        while True:
+            name = self.field()
+            self.expect("as")
+            new_name = self.new_name()
+            self.fields[new_name] = self.fields.pop(name)
+            if not self.accept(","):
+                break
+
+    def sort(self):
+        while True:
+            if not self.accept("-"):
+                self.accept("+")
+            self.field()
+            if not self.accept(","):
+                break
+
+    def dedup(self):
+        if self.peek()[0] == "number":
+            self.next()
+        self.field_list()
+
+    def head(self):
+        kind, text = self.peek()
+        if kind == "number":
+            self.next()
+            if not text.isdigit():
+                raise InvalidQuery(f"head takes a non-negative integer, found {text}")
+
+    def top_rare(self, allow_count):
+        if allow_count and self.peek()[0] == "number":
+            _, text = self.next()
+            if not text.isdigit():
+                raise InvalidQuery(f"expected a non-negative integer, found {text}")
+        names = self.field_list()
+        if self.accept("by"):
+            names += self.field_list()
+        self.fields = {name: self.fields[name] for name in names}
+
+    def stats(self):
+        output = {}
+        while True:
+            kind, func = self.next()
+            if kind != "name" or func.lower() not in AGGREGATIONS:
+                raise InvalidQuery(f"unknown aggregation {func!r}")
+            self.expect("(")
+            if func.lower() == "count" and self.accept(")"):
+                output["count()"] = "int"
+            else:
+                name = self.field()
+                allowed = AGGREGATIONS[func.lower()]
+                if allowed is not None and self.fields[name] not in allowed:
+                    raise InvalidQuery(f"{func} on {self.fields[name]} field {name}")
+                self.expect(")")
+                output[f"{func}({name})"] = "float" if func.lower() == "avg" else self.fields[name]
+                if func.lower() == "count":
+                    output[f"{func}({name})"] = "int"
+            if not self.accept(","):
+                break
+        if self.accept("by"):
+            for name in self.field_list():
+                output[name] = self.fields[name]
+        self.fields = output
+
+    def eval_cmd(self):
+        new_name = self.new_name()
+        self.expect("=")
+        kind, func = self.next()
+        if kind != "name" or func.upper() not in TIME_PARTS:
+            raise InvalidQuery(f"unsupported eval expression {func!r}")
+        self.expect("(")
+        name = self.field()
+        if self.fields[name] != "time":
+            raise InvalidQuery(f"{func} on {self.fields[name]} field {name}")
+        self.expect(")")
+        self.fields[new_name] = "int"
+
+    def parse(self):
+        name = self.field()
+        if self.fields[name] not in STRING_TYPES:
+            raise InvalidQuery(f"parse on {self.fields[name]} field {name}")
+        kind, text = self.next()
+        if kind != "string":
+            raise InvalidQuery(f"parse pattern must be a string, found {text!r}")
+        try:
+            pattern = re.compile(PPL_GROUP_RE.sub("(?P<", ast.literal_eval(text)))
+        except re.error as e:
+            raise InvalidQuery(f"invalid parse pattern {text}: {e}")
+        if not pattern.groupindex:
+            raise InvalidQuery(f"parse pattern {text} has no named groups")
+        for group in pattern.groupindex:
+            self.fields[group] = self.fields[name]
+
+
+COMMANDS = {
+    "where": SegmentChecker.where,
+    "fields": SegmentChecker.fields_cmd,
+    "rename": SegmentChecker.rename,
+    "sort": SegmentChecker.sort,
+    "dedup": SegmentChecker.dedup,
+    "head": SegmentChecker.head,
+    "top": lambda checker: checker.top_rare(allow_count=True),
+    "rare": lambda checker: checker.top_rare(allow_count=False),
+    "stats": SegmentChecker.stats,
+    "eval": SegmentChecker.eval_cmd,
+    "parse": SegmentChecker.parse,
+}
+
+
+def split_segments(ppl_query: str, index_name: str | None = None) -> list[tuple[str, list]]:
+    """
+    Tokenize a query and split it into `(command, tokens)` pairs, after checking the leading
+    `source = ...`. If `index_name` is given, the source must be that index.
+    """
+    segments, current = [], []
+    for token in tokenize(ppl_query):
+        if token == ("op", "|"):
+            segments.append(current)
+            current = []
+        else:
+            current.append(token)
+    segments.append(current)
+
+    source = SegmentChecker(segments[0], {})
+    source.expect("source")
+    source.expect("=")
+    kind, index = source.next()
+    if kind != "name" or (index_name is not None and field_name(index) != index_name):
+        raise InvalidQuery(f"unexpected source {index!r}")
+    source.done()
+
+    result = []
+    for segment in segments[1:]:
+        if not segment:
+            raise InvalidQuery("empty command")
+        kind, command = segment[0]
+        if kind != "name":
+            raise InvalidQuery(f"unknown command {command!r}")
+        result.append((command.lower(), segment[1:]))
+    return result
+
+
+def schema_fields(schema: Schema | dict) -> dict[str, str]:
+    if not isinstance(schema, Schema):
+        schema = Schema(schema)
+    return {field_name(key): props["type"] for key, props in schema.fields.items()}
+
+
+def validate_query(ppl_query: str, fields: dict[str, str], index_name: str | None = None):
+    """
+    Check a query against the fields of a schema (see `schema_fields`), raising InvalidQuery if it
+    can't be valid. If `index_name` is given, the query's source must be that index.
+    """
+    segments = split_segments(ppl_query, index_name)
+    checker_fields = dict(fields)
+    for command, tokens in segments:
+        if command not in COMMANDS:
+            raise InvalidQuery(f"unknown command {command!r}")
+        checker = SegmentChecker(tokens, checker_fields)
+        COMMANDS[command](checker)
+        checker.done()
+        checker_fields = checker.fields
+
+
+def validate_all(ppl_queries, schema: Schema | dict, index_name: str | None = None):
+    """
+    Pipeline stage yielding only the queries that pass `validate_query`. Rejected queries are
+    reported on stderr, with a count once the input is exhausted.
+    """
+    fields = schema_fields(schema)
+    total, rejected = 0, 0
+    for ppl_query in ppl_queries:
+        total += 1
+        try:
+            validate_query(ppl_query, fields, index_name)
+        except InvalidQuery as e:
+            rejected += 1
+            print(f"Rejected by validator:\n> Query: {ppl_query}\n> Error: {e}", file=sys.stderr)
+            continue
+        yield ppl_query
+    print(f"Validator rejected {rejected} of {total} queries", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: validate_query.py [schema] < queries.txt")
+        sys.exit(1)
+    with open(f"schemas/{sys.argv[1]}.json", "r") as schema_file:
+        schema = json.load(schema_file)
+    for ppl_query in validate_all((line.strip() for line in sys.stdin if line.strip()), schema):
+        print(ppl_query)
@@ -1,8 +1,24 @@
+import functools
 import json
-from opensearchpy import OpenSearch
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+from pipeline import bounded_map
+from query_cache import ResultCache
 import sys
 
-def run_ppl_query(client: OpenSearch, ppl_query: str) -> dict:
+# The client library is only imported once a client is made, so generate-only runs never load it
+if TYPE_CHECKING:
+    from opensearchpy import OpenSearch
+
+# How queries are checked by the cluster:
+# - run: execute the query and download the full result
+# - discard: execute the query, but cap the result at DISCARD_ROW_CAP rows and don't keep it
+# - explain: only plan the query with the explain API, without executing it
+VERIFY_MODES = ("run", "discard", "explain")
+DISCARD_ROW_CAP = 1
+
+def run_ppl_query(client: "OpenSearch", ppl_query: str, mode: str = "run") -> dict:
     """
     Send a ppl query to the OpenSearch cluster.
 
@@ -13,54 +29,134 @@ def run_ppl_query(client: OpenSearch, ppl_query: str) -> dict:
                 The OpenSearch client.
     ppl_query: str
                 The PPL query.
+    mode: str
+                One of VERIFY_MODES. Only "run" keeps the response.
 
 
     Returns
     -------
-    result: str
-                The result.
+    result: dict
+                The result, with the request's round trip in `seconds`.
     """
-    request = "/_plugins/_ppl"
+    request = "/_plugins/_ppl/_explain" if mode == "explain" else "/_plugins/_ppl"
+    if mode == "discard":
+        # A trailing head is valid after any command, and stops the cluster from gathering and
+        # sending back rows we'd throw away anyway
+        ppl_query = f"{ppl_query} | head {DISCARD_ROW_CAP}"
     query = json.dumps({"query": ppl_query})
 
     result = {}
+    start = time.perf_counter()
     try:
-        result["response"] = client.transport.perform_request(
+        response = client.transport.perform_request(
             "POST", request, body=query
         )
+        result["response"] = response if mode == "run" else None
         result["success"] = 1
         result["error"] = None
     except Exception as re:
+        # Only transport errors carry a status code and error type; anything else still counts as
+        # one failed request, not a failed run
         result["response"] = None
         result["success"] = 0
-        result["status_code"] = re.status_code
-        result["error"] = re.error
+        result["status_code"] = getattr(re, "status_code", None)
+        result["error"] = getattr(re, "error", str(re))
+    result["seconds"] = time.perf_counter() - start
     return result
 
-def verify(client: OpenSearch, ppl_query: str):
-    result = run_ppl_query(client, ppl_query)
+def report(ppl_query: str, result: dict):
     if result["success"] == 1:
-        print(ppl_query)
+        print(ppl_query, flush=True)
     else:
         print(f"Encountered error:\n> Query: {ppl_query}\n> Error: {result['error']}", file=sys.stderr)
 
-def make_client():
+def verify(client: "OpenSearch", ppl_query: str):
+    result = run_ppl_query(client, ppl_query)
+    report(ppl_query, result)
+
+def run_cached_ppl_query(client: "OpenSearch", cache: ResultCache | None, ppl_query: str, mode: str = "run") -> dict:
+    """
+    `run_ppl_query`, but answered from `cache` when the cluster has already seen the query. The
+    cache should only hold results from the same verification mode.
+    """
+    if cache is None:
+        return run_ppl_query(client, ppl_query, mode)
+    result = cache.get(ppl_query)
+    if result is None:
+        result = run_ppl_query(client, ppl_query, mode)
+        cache.put(ppl_query, result)
+    return result
+
+def run_ppl_queries(
+    client: "OpenSearch", ppl_queries, max_in_flight: int = 8, cache: ResultCache | None = None, mode: str = "run"
+):
+    """
+    Concurrent version of `run_ppl_query`. At most `max_in_flight` requests are outstanding at
+    once, and `(query, result)` pairs are yielded in the same order as `ppl_queries`. The client
+    should have a connection pool at least `max_in_flight` wide (see `make_client`).
+    """
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        run = functools.partial(run_cached_ppl_query, client, cache, mode=mode)
+        yield from bounded_map(executor, run, ppl_queries, max_in_flight)
+
+def verify_all(
+    client: "OpenSearch",
+    ppl_queries,
+    max_in_flight: int = 8,
+    cache: ResultCache | None = None,
+    mode: str = "run",
+    write=None,
+):
+    """
+    Verify every query with up to `max_in_flight` concurrent requests, printing results in input
+    order, or passing each `(query, result)` to `write` instead if it's given. Reports the achieved
+    throughput (and cache hit rate) on stderr once all queries are done.
+    """
+    start, count = time.perf_counter(), 0
+    for ppl_query, result in run_ppl_queries(client, ppl_queries, max_in_flight, cache, mode):
+        if write is not None:
+            write(ppl_query, result)
+        else:
+            report(ppl_query, result)
+        count += 1
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print(f"Verified {count} queries in {elapsed:.2f}s ({rate:.1f} queries/s)", file=sys.stderr)
+    if cache is not None:
+        print(cache.summary(), file=sys.stderr)
+    from nodes import nodes_summary
+
+    nodes = nodes_summary(client)
+    if nodes is not None:
+        print(nodes, file=sys.stderr)
+
+def make_client(pool_maxsize: int = 10, balance: str | None = None):
+    """
+    Client for the cluster in `client_conf.json`. The config has either a `host` or a list of
+    `hosts` (see `nodes.parse_hosts`), and optionally `user` and `pass`, `use_ssl` (default true),
+    `balance` ("round-robin" or "least-outstanding", overridden by `balance`) and `dead_timeout`
+    (seconds a failing node is left out of rotation).
+    """
+    from nodes import DEFAULT_DEAD_TIMEOUT, make_node_client, parse_hosts
+
     try:
         with open("client_conf.json", "r") as conf_file:
             conf = json.load(conf_file)
     except FileNotFoundError:
-        print("No config found.\nThere must be a file `client_conf.json` with `host`, `user`, and `pass` keys.")
+        print("No config found.\nThere must be a file `client_conf.json` with `host` (or `hosts`), `user`, and `pass` keys.")
         sys.exit(1)
-    
-    host = conf["host"]
-    port = 443
-    auth = (conf["user"], conf["pass"])
-
-    return OpenSearch(
-        hosts = [{'host': host, 'port': port}],
-        http_compress = True, 
+
+    auth = (conf["user"], conf["pass"]) if "user" in conf else None
+
+    return make_node_client(
+        parse_hosts(conf),
+        balance = balance or conf.get("balance", "round-robin"),
+        # Connections are reused across verification threads, so size the pool to the in-flight limit
+        pool_maxsize = pool_maxsize,
+        dead_timeout = conf.get("dead_timeout", DEFAULT_DEAD_TIMEOUT),
+        http_compress = True,
         http_auth = auth,
-        use_ssl = True,
+        use_ssl = conf.get("use_ssl", True),
         verify_certs = False,
         ssl_assert_hostname = False,
         ssl_show_warn = False,